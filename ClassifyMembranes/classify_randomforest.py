@@ -15,45 +15,24 @@ import h5py
 import glob
 import mahotas
 import timer
+import packed_forest
 
-#from rf_classify_parallel import rf_classify
-from rf_classify import rf_classify
+#from rf_classify import rf_classify
+from rf_classify_parallel import rf_classify
 
 features_file = sys.argv[1]
 forest_file = sys.argv[2]
 output_file = sys.argv[3]
 
-NODE_TERMINAL = -1
-NODE_TOSPLIT  = -2
-NODE_INTERIOR = -3
-
 Debug = False
 
-# Load the forest settings
-
-class rf_model (object):
-    def __init__(self, path):
-
-	print 'Opening rf model file {0}'.format(path)
-
-        model = h5py.File(path, 'r')
-
-        self.treemap = model['/forest/treemap'][...]
-        self.nodestatus = model['/forest/nodestatus'][...]
-        self.xbestsplit = model['/forest/xbestsplit'][...]
-        self.bestvar = model['/forest/bestvar'][...]
-        self.nodeclass = model['/forest/nodeclass'][...]
-
-        self.nrnodes = model['/forest/nrnodes'][...];
-        self.ntree = model['/forest/ntree'][...];
-        self.nclass = model['/forest/nclass'][...];
-
-        model.close()
-
+# Threads for classification (0 uses every core), and pixels per work tile
+classify_threads = 0
+classify_tile_size = 256
 
 # Load model
 with timer.Timer("loading model"):
-    model = rf_model(forest_file)
+    model = packed_forest.load_forest(forest_file)
 
 # Loading features
 with timer.Timer("loading features"):
@@ -70,7 +49,7 @@ with timer.Timer("loading features"):
 
 #Run random forest classifier
 with timer.Timer("classification"):
-    votes = rf_classify(model, features)
+    votes = rf_classify(model, features, classify_threads, classify_tile_size)
 
 #Save results
 with timer.Timer("saving"):
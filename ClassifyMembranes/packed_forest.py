@@ -0,0 +1,122 @@
+############################################################
+# Packed Random Forest model format
+############################################################
+# The trainers write each forest as separate [ntree, nrnodes] arrays under
+# /forest, padded to the size of the largest tree.  The packed format keeps
+# only the nodes each tree actually uses, in one contiguous array of
+# nodes per forest (/packed_forest/nodes), with the root of each tree in
+# /packed_forest/roots.
+#
+# Nodes of each tree are stored in depth-first order, so the left child of
+# a split always directly follows it, and only the right child needs an
+# offset.  Terminal nodes have feature == -1.
+#
+# Usage: python packed_forest.py FOREST.hdf5 PACKED_FOREST.hdf5
+############################################################
+
+import numpy as np
+import os
+import sys
+import h5py
+
+NODE_TERMINAL = -1
+
+NODE_DTYPE = np.dtype([('feature', np.int32),     # 0-based feature index, -1 for terminal nodes
+                       ('split', np.float32),     # go right if feature value > split
+                       ('right', np.int32),       # index of the right child in nodes
+                       ('vote_class', np.int32)]) # 0-based class, for terminal nodes
+
+PACKED_NAME = 'packed_forest'
+
+class PackedForest(object):
+    def __init__(self, nodes, roots, nclass):
+        self.nodes = np.ascontiguousarray(nodes, dtype=NODE_DTYPE)
+        self.roots = np.ascontiguousarray(roots, dtype=np.int32)
+        self.ntree = len(self.roots)
+        self.nclass = int(nclass)
+
+def pack_forest(treemap, nodestatus, xbestsplit, bestvar, nodeclass, nrnodes, ntree, nclass):
+    # flattened, node k of tree treei is at treei * nrnodes + k, and its
+    # (1-based) children are at twice that in treemap
+    nrnodes = int(nrnodes)
+    ntree = int(ntree)
+    treemap = np.asarray(treemap).ravel()
+    nodestatus = np.asarray(nodestatus).ravel()
+    xbestsplit = np.asarray(xbestsplit).ravel()
+    bestvar = np.asarray(bestvar).ravel()
+    nodeclass = np.asarray(nodeclass).ravel()
+
+    nodes = []
+    roots = np.zeros(ntree, dtype=np.int32)
+    for treei in range(ntree):
+        tree_offset = treei * nrnodes
+        roots[treei] = len(nodes)
+        # depth-first, left child first.  Each stack entry is the old node
+        # index and the packed parent whose right child it is (or -1).
+        stack = [(0, -1)]
+        while stack:
+            k, right_of = stack.pop()
+            if right_of >= 0:
+                nodes[right_of][2] = len(nodes)
+            if nodestatus[tree_offset + k] == NODE_TERMINAL:
+                nodes.append([-1, 0.0, -1, nodeclass[tree_offset + k] - 1])
+            else:
+                nodes.append([bestvar[tree_offset + k] - 1, xbestsplit[tree_offset + k], -1, -1])
+                stack.append((treemap[(tree_offset + k) * 2 + 1] - 1, len(nodes) - 1))
+                stack.append((treemap[(tree_offset + k) * 2] - 1, -1))
+
+    packed = np.zeros(len(nodes), dtype=NODE_DTYPE)
+    if len(nodes) > 0:
+        nodes = np.array(nodes, dtype=np.float64)
+        packed['feature'] = nodes[:, 0]
+        packed['split'] = nodes[:, 1]
+        packed['right'] = nodes[:, 2]
+        packed['vote_class'] = nodes[:, 3]
+    return PackedForest(packed, roots, nclass)
+
+def write_packed_forest(h5file, forest):
+    group = h5file.create_group(PACKED_NAME)
+    group.create_dataset('nodes', data=forest.nodes)
+    group.create_dataset('roots', data=forest.roots)
+    group.create_dataset('nclass', data=forest.nclass)
+
+def read_packed_forest(h5file):
+    # pack on the fly for models written without a packed forest
+    if PACKED_NAME in h5file:
+        group = h5file[PACKED_NAME]
+        return PackedForest(group['nodes'][...], group['roots'][...], group['nclass'][...])
+
+    print 'Packing unpacked forest'
+    return pack_forest(h5file['/forest/treemap'][...],
+                       h5file['/forest/nodestatus'][...],
+                       h5file['/forest/xbestsplit'][...],
+                       h5file['/forest/bestvar'][...],
+                       h5file['/forest/nodeclass'][...],
+                       h5file['/forest/nrnodes'][...],
+                       h5file['/forest/ntree'][...],
+                       h5file['/forest/nclass'][...])
+
+def load_forest(path):
+    print 'Opening rf model file {0}'.format(path)
+    model = h5py.File(path, 'r')
+    forest = read_packed_forest(model)
+    model.close()
+    return forest
+
+if __name__ == '__main__':
+    forest_file = sys.argv[1]
+    output_file = sys.argv[2]
+
+    forest = load_forest(forest_file)
+
+    temp_path = output_file + '_tmp'
+    out_hdf5 = h5py.File(temp_path, 'w')
+    write_packed_forest(out_hdf5, forest)
+    out_hdf5.close()
+
+    # move to final location
+    if os.path.exists(output_file):
+        os.unlink(output_file)
+    os.rename(temp_path, output_file)
+
+    print 'Packed {0} trees into {1} nodes.'.format(forest.ntree, len(forest.nodes))
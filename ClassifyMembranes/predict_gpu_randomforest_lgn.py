@@ -14,6 +14,7 @@ import sys
 import h5py
 import glob
 import mahotas
+import packed_forest
 
 import pycuda.autoinit
 import pycuda.driver as cu
@@ -21,42 +22,36 @@ import pycuda.compiler as nvcc
 import pycuda.gpuarray as gpuarray
 
 gpu_randomforest_predict_source = """
-#define NODE_TERMINAL -1
-#define NODE_TOSPLIT  -2
-#define NODE_INTERIOR -3
-
-__global__ void predictKernel(const float *x, int n, int mdim, const int *treemap,
-		      const int *nodestatus, const float *xbestsplit,
-		      const int *bestvar, const int *nodeclass,
-		      int nclass,
-			  int ntree, int *countts, int maxTreeSize)
-		      //int *jts,
-			  //int *nodex,
+// Must match packed_forest.NODE_DTYPE
+struct ForestNode {
+	int feature;
+	float split;
+	int right;
+	int vote_class;
+};
+
+__global__ void predictKernel(const float *x, int n, int mdim, const ForestNode *nodes,
+		      const int *roots, int nclass,
+			  int ntree, int *countts)
 {
 	int idx = threadIdx.x + blockDim.x * (blockIdx.x + gridDim.x * blockIdx.y);
 
 	//Make sure we don't overrun
 	if (idx < n) {
-		int m, k, treei, treeOffset1, treeOffset2;
+		int k, treei;
 
 		//Repeat for each tree - this way only one thread writes to any point in the vote output array
 
 		for (treei = 0; treei < ntree; ++treei) {
-		//for (treei = 0; treei < ntree; ++treei) {
-			treeOffset1 = treei*maxTreeSize;
-			treeOffset2 = treei*2*maxTreeSize;
-			k = 0;
-
-			while (nodestatus[treeOffset1 + k] != NODE_TERMINAL) {
-				m = bestvar[treeOffset1 + k] - 1;
-				//Split by a numerical predictor
-				k = (x[idx + n * m] <= xbestsplit[treeOffset1 + k]) ?
-					treemap[treeOffset2 + k * 2] - 1 : treemap[treeOffset2 + 1 + k * 2] - 1;
+			k = roots[treei];
+
+			while (nodes[k].feature >= 0) {
+				//Split by a numerical predictor, left child is next
+				k = (x[idx + n * nodes[k].feature] <= nodes[k].split) ?
+					k + 1 : nodes[k].right;
 			}
 			//We found the terminal node: assign class label
-			//jts[chunki + treei] = nodeclass[treeOffset + k];
-			//nodex[chunki + treei] = k + 1;
-			countts[idx * nclass + nodeclass[treeOffset1 + k] - 1] += 1;
+			countts[idx * nclass + nodes[k].vote_class] += 1;
 		}
 	}
 
@@ -71,21 +66,17 @@ output_folder = 'D:\\dev\\Rhoana\\classifierTraining\\LGNTraining\\LGNTraining_n
 
 # Load the forest settings
 
-model = h5py.File(forest_file, 'r')
+forest = packed_forest.load_forest(forest_file)
 
 
 # Prep the gpu function
 gpu_predict = nvcc.SourceModule(gpu_randomforest_predict_source).get_function('predictKernel')
 
-d_treemap = gpuarray.to_gpu(model['/forest/treemap'][...])
-d_nodestatus = gpuarray.to_gpu(model['/forest/nodestatus'][...])
-d_xbestsplit = gpuarray.to_gpu(model['/forest/xbestsplit'][...])
-d_bestvar = gpuarray.to_gpu(model['/forest/bestvar'][...])
-d_nodeclass = gpuarray.to_gpu(model['/forest/nodeclass'][...])
+d_nodes = cu.to_device(forest.nodes)
+d_roots = gpuarray.to_gpu(forest.roots)
 
-nrnodes = model['/forest/nrnodes'][...];
-ntree = model['/forest/ntree'][...];
-nclass = model['/forest/nclass'][...];
+ntree = forest.ntree
+nclass = forest.nclass
 
 
 files = sorted( glob.glob( input_image_folder + '\\*' + input_image_suffix ) )
@@ -118,8 +109,8 @@ for file in files:
 	grid = (1024, int(fshape[1] / block[0] / 1024 + 1))
 
 	gpu_predict(d_features, np.int32(fshape[1]), np.int32(fshape[0]),
-		d_treemap, d_nodestatus, d_xbestsplit, d_bestvar, d_nodeclass,
-		np.int32(nclass), np.int32(ntree), d_votes, np.int32(nrnodes),
+		d_nodes, d_roots,
+		np.int32(nclass), np.int32(ntree), d_votes,
 		grid=grid, block=block)
 
 
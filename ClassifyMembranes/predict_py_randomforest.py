@@ -14,28 +14,23 @@ import sys
 import h5py
 import glob
 import mahotas
+import packed_forest
 
 features_file = sys.argv[1]
 forest_file = sys.argv[2]
 output_file = sys.argv[3]
 
-NODE_TERMINAL = -1
-NODE_TOSPLIT  = -2
-NODE_INTERIOR = -3
+# Load the forest
 
-# Load the forest settings
+forest = packed_forest.load_forest(forest_file)
 
-model = h5py.File(forest_file, 'r')
+feature = forest.nodes['feature']
+split = forest.nodes['split']
+right = forest.nodes['right']
+node_vote = forest.nodes['vote_class']
 
-treemap = model['/forest/treemap'][...]
-nodestatus = model['/forest/nodestatus'][...]
-xbestsplit = model['/forest/xbestsplit'][...]
-bestvar = model['/forest/bestvar'][...]
-nodeclass = model['/forest/nodeclass'][...]
-
-nrnodes = model['/forest/nrnodes'][...];
-ntree = model['/forest/ntree'][...];
-nclass = model['/forest/nclass'][...];
+ntree = forest.ntree
+nclass = forest.nclass
 
 # Load the features
 f = h5py.File(features_file, 'r')
@@ -53,26 +48,23 @@ for i,k in enumerate(f.keys()):
 # Predict
 
 votes = np.zeros((npix, nclass), dtype=np.int32)
+all_pix = np.arange(npix)
 
 for treei in range(ntree):
 
-	k = np.zeros((npix), dtype=np.int32)
+	k = np.zeros((npix), dtype=np.int32) + forest.roots[treei]
 
-	non_terminal = np.nonzero(nodestatus[treei, k] != NODE_TERMINAL)[0]
+	non_terminal = np.nonzero(feature[k] >= 0)[0]
 	while len(non_terminal) > 0:
 		knt = k[non_terminal]
-		m = bestvar[treei, knt] - 1
-		#Split by a numerical predictor
-		choice = 1 * (features[m, non_terminal] > xbestsplit[treei, knt])
-		k[non_terminal] = treemap[treei * 2, knt * 2 + choice] - 1
-		non_terminal = np.nonzero(nodestatus[treei, k] != NODE_TERMINAL)[0]
+		#Split by a numerical predictor, left child is next
+		go_right = features[feature[knt], non_terminal] > split[knt]
+		k[non_terminal] = np.where(go_right, right[knt], knt + 1)
+		non_terminal = non_terminal[feature[k[non_terminal]] >= 0]
 		#print "{0} non terminal nodes.".format(len(non_terminal))
 
 	#We found all terminal nodes: assign class label
-	#jts[chunki + treei] = nodeclass[treeOffset + k]
-	#nodex[chunki + treei] = k + 1
-	cast_votes = nodeclass[treei, k] - 1
-	votes[range(npix),cast_votes] = votes[range(npix),cast_votes] + 1
+	votes[all_pix, node_vote[k]] += 1
 
 	print "Done tree {0} of {1}.".format(treei+1, ntree)
 
@@ -4,29 +4,28 @@
 import numpy as np
 cimport numpy as np
 
-cpdef rf_classify(model, float[:,:] features):
-
-    cdef int NODE_TERMINAL, nfeatures, npix, treei, k, m, choice, vote_class, nrnodes, ntree, nclass, pixi
-    cdef int [:,:] treemap, nodestatus, bestvar, nodeclass, votes
-    cdef float [:,:] xbestsplit
+# Must match packed_forest.NODE_DTYPE
+cdef packed struct forest_node:
+    np.int32_t feature
+    np.float32_t split
+    np.int32_t right
+    np.int32_t vote_class
+
+cpdef rf_classify(forest, float[:,:] features):
+
+    cdef int nfeatures, npix, treei, k, ntree, nclass, pixi
+    cdef forest_node [:] nodes
+    cdef int [:] roots
+    cdef int [:,:] votes
     cdef float[:] pixel_features
 
-    NODE_TERMINAL = -1
-    #NODE_TOSPLIT  = -2
-    #NODE_INTERIOR = -3
-
     nfeatures = features.shape[0]
     npix = features.shape[1]
 
-    treemap = model.treemap
-    nodestatus = model.nodestatus
-    xbestsplit = model.xbestsplit
-    bestvar = model.bestvar
-    nodeclass = model.nodeclass
-
-    nrnodes = model.nrnodes
-    ntree = model.ntree
-    nclass = model.nclass
+    nodes = forest.nodes
+    roots = forest.roots
+    ntree = forest.ntree
+    nclass = forest.nclass
 
     # Predict
     votes = np.zeros((npix, nclass), dtype=np.int32)
@@ -38,15 +37,15 @@ cpdef rf_classify(model, float[:,:] features):
 
         for treei in range(ntree):
 
-            k = 0
-            while nodestatus[treei, k] != NODE_TERMINAL:
-                m = bestvar[treei, k] - 1
-                #Split by a numerical predictor
-                choice = 1 * (pixel_features[m] > xbestsplit[treei, k])
-                k = treemap[treei * 2, k * 2 + choice] - 1
+            k = roots[treei]
+            while nodes[k].feature >= 0:
+                #Split by a numerical predictor, left child is next
+                if pixel_features[nodes[k].feature] > nodes[k].split:
+                    k = nodes[k].right
+                else:
+                    k = k + 1
 
             #We found the terminal node: assign class label
-            vote_class = nodeclass[treei, k] - 1
-            votes[pixi,vote_class] = votes[pixi,vote_class] + 1
+            votes[pixi, nodes[k].vote_class] = votes[pixi, nodes[k].vote_class] + 1
 
-    return votes
+    return np.asarray(votes)
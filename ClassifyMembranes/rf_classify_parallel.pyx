@@ -3,53 +3,66 @@
 
 import numpy as np
 cimport numpy as np
+cimport openmp
 from cython.parallel cimport prange
 
-cpdef rf_classify(model, float[:,:] features):
+# Must match packed_forest.NODE_DTYPE
+cdef packed struct forest_node:
+    np.int32_t feature
+    np.float32_t split
+    np.int32_t right
+    np.int32_t vote_class
 
-    cdef int NODE_TERMINAL, nfeatures, npix, treei, k, m, choice, vote_class, nrnodes, ntree, nclass, pixi
-    cdef int [:,:] treemap, nodestatus, bestvar, nodeclass, votes
-    cdef float [:,:] xbestsplit
-    cdef float[:] pixel_features
+# Pixels are split into tiles, and each thread classifies whole tiles with
+# every tree.  Each pixel's votes are only written by the thread that owns
+# its tile, so no locking is needed, and the top of each tree stays in cache
+# while the tile's pixels run down it.
+cpdef rf_classify(forest, float[:,:] features, int num_threads=0, int tile_size=256):
 
-    NODE_TERMINAL = -1
-    #NODE_TOSPLIT  = -2
-    #NODE_INTERIOR = -3
+    cdef int npix, treei, k, ntree, nclass, pixi
+    cdef int tilei, ntiles, tile_start, tile_end
+    cdef forest_node [:] nodes
+    cdef int [:] roots
+    cdef int [:,:] votes
 
-    nfeatures = features.shape[0]
     npix = features.shape[1]
 
-    treemap = model.treemap
-    nodestatus = model.nodestatus
-    xbestsplit = model.xbestsplit
-    bestvar = model.bestvar
-    nodeclass = model.nodeclass
+    nodes = forest.nodes
+    roots = forest.roots
+    ntree = forest.ntree
+    nclass = forest.nclass
 
-    nrnodes = model.nrnodes
-    ntree = model.ntree
-    nclass = model.nclass
+    if num_threads <= 0:
+        num_threads = openmp.omp_get_max_threads()
+    if tile_size <= 0:
+        tile_size = 256
+    ntiles = (npix + tile_size - 1) // tile_size
 
     # Predict
     votes = np.zeros((npix, nclass), dtype=np.int32)
-    pixel_features = np.zeros(nfeatures, dtype=np.float32)
 
-    for pixi in range(npix):
+    with nogil:
 
-        pixel_features[...] = features[:,pixi]
+        for tilei in prange(ntiles, schedule='dynamic', num_threads=num_threads):
 
-        with nogil:
+            tile_start = tilei * tile_size
+            tile_end = tile_start + tile_size
+            if tile_end > npix:
+                tile_end = npix
 
-            for treei in prange(ntree, schedule='static', num_threads=16):
+            for treei in range(ntree):
 
-                k = 0
-                while nodestatus[treei, k] != NODE_TERMINAL:
-                    m = bestvar[treei, k] - 1
-                    #Split by a numerical predictor
-                    choice = 1 * (pixel_features[m] > xbestsplit[treei, k])
-                    k = treemap[treei * 2, k * 2 + choice] - 1
+                for pixi in range(tile_start, tile_end):
 
-                #We found the terminal node: assign class label
-                vote_class = nodeclass[treei, k] - 1
-                votes[pixi,vote_class] = votes[pixi,vote_class] + 1
+                    k = roots[treei]
+                    while nodes[k].feature >= 0:
+                        #Split by a numerical predictor, left child is next
+                        if features[nodes[k].feature, pixi] > nodes[k].split:
+                            k = nodes[k].right
+                        else:
+                            k = k + 1
 
-    return votes
+                    #We found the terminal node: assign class label
+                    votes[pixi, nodes[k].vote_class] = votes[pixi, nodes[k].vote_class] + 1
+
+    return np.asarray(votes)
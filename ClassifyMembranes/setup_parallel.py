@@ -2,10 +2,19 @@ from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
 import numpy as np
+import sys
+
+if sys.platform == 'win32':
+    openmp_args = ['/openmp']
+    openmp_link_args = []
+else:
+    openmp_args = ['-fopenmp']
+    openmp_link_args = ['-fopenmp']
 
 setup(
     cmdclass = {'build_ext': build_ext},
-    ext_modules = [Extension("rf_classify_parallel", ["rf_classify_parallel.pyx"])],
-    extra_compile_args=['/openmp'],
+    ext_modules = [Extension("rf_classify_parallel", ["rf_classify_parallel.pyx"],
+                             extra_compile_args=openmp_args,
+                             extra_link_args=openmp_link_args)],
     include_dirs = [np.get_include()]
-)
\ No newline at end of file
+)
@@ -13,6 +13,7 @@ import sys
 import h5py
 import glob
 import mahotas
+import packed_forest
 import subprocess
 import os
 
@@ -642,4 +643,8 @@ out_hdf5['/forest/nclass'] = nclass
 out_hdf5['/forest/classweights'] = classweights
 out_hdf5['/forest/mtry'] = mtry
 
+# Packed copy for prediction
+packed_forest.write_packed_forest(out_hdf5, packed_forest.pack_forest(treemap, nodestatus,
+    xbestsplit, bestvar, nodeclass, maxTreeSize, ntree, nclass))
+
 out_hdf5.close()
@@ -0,0 +1,89 @@
+import os
+import json
+import h5py
+import numpy as np
+
+# Diced blocks are HDF5 copies of a crop of the volume, with
+# 'segmentations' [height, width, nsegs, nslices] and 'probabilities'
+# [height, width, nslices].  Without the copy (DICE_BLOCKS = False in the
+# driver), dice_block.py writes a block description instead - a small JSON
+# file with the crop and the section files - and the same datasets are read
+# straight from the sections when they are used.
+
+BLOCK_DESCRIPTION_EXTENSION = '.json'
+
+def is_block_description(path):
+    return path.endswith(BLOCK_DESCRIPTION_EXTENSION)
+
+def write_block_description(path, i_min, j_min, i_max, j_max, input_slices):
+    description = {'i_min': i_min, 'j_min': j_min, 'i_max': i_max, 'j_max': j_max,
+                   'input_slices': list(input_slices)}
+    with open(path + '_partial', 'w') as f:
+        json.dump(description, f, indent=1)
+    os.rename(path + '_partial', path)
+
+class SectionDataset(object):
+    '''One dataset of a described block, read from the section files.
+
+    Indexed like the diced dataset, with sections on the last axis.  A whole
+    section's crop is read at a time, and the last one is kept, so reading a
+    section one segmentation at a time only reads it once.
+    '''
+    def __init__(self, block, name):
+        self.block = block
+        self.name = name
+        f = h5py.File(block.input_slices[0], 'r')
+        dataset = f[name]
+        self.dtype = dataset.dtype
+        self.shape = (block.i_max - block.i_min, block.j_max - block.j_min) + dataset.shape[2:] + (len(block.input_slices),)
+        f.close()
+        self.ndim = len(self.shape)
+        self.section_idx = None
+        self.section = None
+
+    def read_section(self, idx):
+        if idx != self.section_idx:
+            f = h5py.File(self.block.input_slices[idx], 'r')
+            self.section = f[self.name][self.block.i_min:self.block.i_max, self.block.j_min:self.block.j_max, ...]
+            f.close()
+            self.section_idx = idx
+        return self.section
+
+    def __getitem__(self, key):
+        if key is Ellipsis:
+            key = ()
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        crop_key, section_key = key[:-1], key[-1]
+        if isinstance(section_key, (int, long, np.integer)):
+            return self.read_section(int(section_key))[crop_key]
+        sections = [self.read_section(idx)[crop_key][..., np.newaxis]
+                    for idx in range(self.shape[-1])[section_key]]
+        return np.concatenate(sections, axis=-1)
+
+class BlockDescription(object):
+    '''A described block, opened like the diced HDF5 file.'''
+    def __init__(self, path):
+        with open(path) as f:
+            description = json.load(f)
+        self.i_min = description['i_min']
+        self.j_min = description['j_min']
+        self.i_max = description['i_max']
+        self.j_max = description['j_max']
+        self.input_slices = description['input_slices']
+
+    def keys(self):
+        return ['segmentations', 'probabilities']
+
+    def __getitem__(self, name):
+        return SectionDataset(self, name)
+
+    def close(self):
+        pass
+
+def open_block(path):
+    # the diced copy, or the sections it would have been diced from
+    if is_block_description(path):
+        return BlockDescription(path)
+    return h5py.File(path, 'r')
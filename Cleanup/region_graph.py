@@ -0,0 +1,142 @@
+import heapq
+
+import numpy as np
+
+class RegionAdjacencyGraph(object):
+    '''Region adjacency graph over packed labels, for joining segments.
+
+    Label 0 is background, and is never joined.  Segments are tracked with
+    union-find, so a merged segment is labeled by the segment it was joined
+    to.  Edges are kept as a dict of dicts, with
+    each undirected edge holding a shared [npix, probability sum] list, so
+    joining a segment only touches its own neighbours.
+    '''
+
+    def __init__(self, label_vol, prob_vol, nlabels):
+        # Code currently only supports a 3d volume
+        assert label_vol.ndim == 3
+
+        self.nlabels = nlabels
+        self.parent = np.arange(self.nlabels)
+        self.sizes = np.bincount(label_vol.ravel(), minlength=self.nlabels)
+
+        # segments touching a cube wall
+        self.on_wall = np.zeros(self.nlabels, dtype=np.bool)
+        for axis in range(label_vol.ndim):
+            for face in [0, -1]:
+                face_slice = tuple(face if i == axis else slice(None) for i in range(label_vol.ndim))
+                self.on_wall[np.unique(label_vol[face_slice])] = True
+
+        # Find neighbouring voxel pairs along each axis, with the mean
+        # boundary probability at each pair.
+        from_labels = []
+        to_labels = []
+        probs = []
+        for axis in range(label_vol.ndim):
+            lo = tuple(slice(None, -1) if i == axis else slice(None) for i in range(label_vol.ndim))
+            hi = tuple(slice(1, None) if i == axis else slice(None) for i in range(label_vol.ndim))
+            borders = (label_vol[lo] != label_vol[hi]) & (label_vol[lo] != 0) & (label_vol[hi] != 0)
+            from_labels.append(label_vol[lo][borders])
+            to_labels.append(label_vol[hi][borders])
+            probs.append((prob_vol[lo][borders].astype(np.float64) + prob_vol[hi][borders]) / 2)
+        from_labels = np.concatenate(from_labels).astype(np.int64)
+        to_labels = np.concatenate(to_labels).astype(np.int64)
+        probs = np.concatenate(probs)
+
+        # accumulate each undirected edge
+        keys = np.minimum(from_labels, to_labels) * self.nlabels + np.maximum(from_labels, to_labels)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        npix = np.bincount(inverse)
+        prob_sums = np.bincount(inverse, weights=probs)
+
+        self.edges = [{} for _ in range(self.nlabels)]
+        for key, n, p in zip(keys, npix, prob_sums):
+            a, b = divmod(int(key), self.nlabels)
+            edge = [int(n), float(p)]
+            self.edges[a][b] = edge
+            self.edges[b][a] = edge
+
+    def find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def neighbours(self, label):
+        return self.edges[self.find(label)].keys()
+
+    def mean_boundary(self, label1, label2):
+        npix, prob_sum = self.edges[label1][label2]
+        return prob_sum / npix
+
+    def best_neighbour(self, label):
+        # the neighbour with the lowest mean boundary probability
+        edges = self.edges[label]
+        if len(edges) == 0:
+            return None
+        return min(edges, key=lambda n: edges[n][1] / edges[n][0])
+
+    def merge(self, label, into_label):
+        # join label into into_label, and link it to its new neighbours
+        label = self.find(label)
+        into_label = self.find(into_label)
+        if label == into_label:
+            return into_label
+
+        self.parent[label] = into_label
+        self.sizes[into_label] += self.sizes[label]
+        self.sizes[label] = 0
+        self.on_wall[into_label] |= self.on_wall[label]
+
+        into_edges = self.edges[into_label]
+        for neighbour, edge in self.edges[label].iteritems():
+            del self.edges[neighbour][label]
+            if neighbour == into_label:
+                continue
+            if neighbour in into_edges:
+                into_edges[neighbour][0] += edge[0]
+                into_edges[neighbour][1] += edge[1]
+            else:
+                into_edges[neighbour] = edge
+                self.edges[neighbour][into_label] = edge
+        self.edges[label] = {}
+        return into_label
+
+    def join_small_segments(self, minsegsize):
+        # Join segments smaller than minsegsize to the neighbour with the
+        # lowest mean boundary probability, smallest first.  The heap is
+        # lazy - entries for segments that have since changed size are
+        # skipped.
+        heap = [(size, label) for label, size in enumerate(self.sizes) if label > 0 and 0 < size < minsegsize]
+        heapq.heapify(heap)
+        joined = 0
+        while heap:
+            size, label = heapq.heappop(heap)
+            if self.sizes[label] != size or self.parent[label] != label:
+                continue
+            best = self.best_neighbour(label)
+            if best is None:
+                continue
+            into_label = self.merge(label, best)
+            joined += 1
+            if joined % 100 == 0:
+                print "Joined {0} segments. Up to size {1}.".format(joined, size)
+            if self.sizes[into_label] < minsegsize:
+                heapq.heappush(heap, (self.sizes[into_label], into_label))
+        return joined
+
+    def join_singly_connected(self):
+        # Join any segments connected to only one other segment, unless they
+        # border a cube wall
+        joined = 0
+        for label in range(1, self.nlabels):
+            if self.parent[label] == label and len(self.edges[label]) == 1 and not self.on_wall[label]:
+                self.merge(label, self.edges[label].keys()[0])
+                joined += 1
+        return joined
+
+    def remap_index(self):
+        return np.array([self.find(label) for label in range(self.nlabels)])
@@ -1,10 +1,27 @@
 import os
 import sys
 import subprocess
+import multiprocessing
 import h5py
+import timer
+import diced_block
 
 job_repeat_attempts = 5
 
+# Number of processes reading (and decompressing) input slices.  The slices
+# are written in the order they are read, a batch of this many at a time.
+dice_read_processes = 4
+
+# Compression of the diced block - 'gzip' (dice_compression_opts is the
+# level, 0-9), 'lzf', or None
+dice_compression = 'gzip'
+dice_compression_opts = None
+
+# Load environment settings
+if 'CONNECTOME_SETTINGS' in os.environ:
+    settings_file = os.environ['CONNECTOME_SETTINGS']
+    execfile(settings_file)
+
 def check_file(filename):
     if not os.path.exists(filename):
         return False
@@ -17,65 +34,106 @@ def check_file(filename):
         return False
     return True
 
-args = sys.argv[1:]
-i_min = int(args.pop(0))
-j_min = int(args.pop(0))
-i_max = int(args.pop(0))
-j_max = int(args.pop(0))
-output = args.pop(0)
-input_slices = args
-
-if os.path.exists(output):
-    print output, "already exists"
-    if check_file(output):
-        sys.exit(0)
-    else:
-        os.unlink(output)
-
-repeat_attempt_i = 0
-while repeat_attempt_i < job_repeat_attempts and not check_file(output):
-
-    repeat_attempt_i += 1
-
-    try:
-        
-        # Write to a temporary location to avoid partial files
-        temp_file_path = output + '_partial'
-        out_f = h5py.File(temp_file_path, 'w')
-
-        num_slices = len(input_slices)
-        for slice_idx, slice in enumerate(input_slices):
-            print slice
-            in_f = h5py.File(slice, 'r')
-            segs = in_f['segmentations'][i_min:i_max, j_min:j_max, :]
-            probs = in_f['probabilities'][i_min:i_max, j_min:j_max]
-            if not 'segmentations' in out_f.keys():
-                outsegs = out_f.create_dataset('segmentations',
-                                               tuple(list(segs.shape) + [num_slices]),
-                                               dtype=segs.dtype,
-                                               chunks=(64, 64, segs.shape[2], 1),
-                                               compression='gzip')
-                outprobs = out_f.create_dataset('probabilities',
-                                               tuple(list(probs.shape) + [num_slices]),
-                                               dtype=probs.dtype,
-                                               chunks=(64, 64, 1),
-                                               compression='gzip')
-            outsegs[:, :, :, slice_idx] = segs
-            outprobs[:, :, slice_idx] = probs
-
-        out_f.close()
-
-        # move to final location
-        os.rename(output + '_partial', output)
+def read_slice(args):
+    slice, i_min, j_min, i_max, j_max = args
+    print slice
+    in_f = h5py.File(slice, 'r')
+    segs = in_f['segmentations'][i_min:i_max, j_min:j_max, :]
+    probs = in_f['probabilities'][i_min:i_max, j_min:j_max]
+    in_f.close()
+    return segs, probs
+
+def dice_block(i_min, j_min, i_max, j_max, output, *input_slices):
+    i_min = int(i_min)
+    j_min = int(j_min)
+    i_max = int(i_max)
+    j_max = int(j_max)
+
+    if diced_block.is_block_description(output):
+        # no copy, later stages read the block straight from the sections
+        diced_block.write_block_description(output, i_min, j_min, i_max, j_max, input_slices)
         print "Successfully wrote", output
+        return
+
+    if os.path.exists(output):
+        print output, "already exists"
+        if check_file(output):
+            return
+        else:
+            os.unlink(output)
+
+    telemetry = timer.Telemetry(output)
+
+    repeat_attempt_i = 0
+    while repeat_attempt_i < job_repeat_attempts and not check_file(output):
+
+        repeat_attempt_i += 1
+
+        try:
 
-    except IOError as e:
-        print "I/O error({0}): {1}".format(e.errno, e.strerror)
-    except KeyboardInterrupt:
-        pass
-    except:
-        print "Unexpected error:", sys.exc_info()[0]
-        if repeat_attempt_i == job_repeat_attempts:
+            # Write to a temporary location to avoid partial files
+            temp_file_path = output + '_partial'
+            out_f = h5py.File(temp_file_path, 'w')
+
+            num_slices = len(input_slices)
+            read_args = [(slice, i_min, j_min, i_max, j_max) for slice in input_slices]
+
+            pool = None
+            if dice_read_processes > 1 and num_slices > 1:
+                pool = multiprocessing.Pool(min(dice_read_processes, num_slices))
+                timer.pool_started(min(dice_read_processes, num_slices))
+            batch_size = max(dice_read_processes, 1)
+
+            for batch_start in range(0, num_slices, batch_size):
+                batch_args = read_args[batch_start:batch_start + batch_size]
+                if pool is not None:
+                    batch = pool.map(read_slice, batch_args)
+                else:
+                    batch = map(read_slice, batch_args)
+
+                for slice_idx, (segs, probs) in enumerate(batch, batch_start):
+                    if not 'segmentations' in out_f.keys():
+                        outsegs = out_f.create_dataset('segmentations',
+                                                       tuple(list(segs.shape) + [num_slices]),
+                                                       dtype=segs.dtype,
+                                                       chunks=(64, 64, segs.shape[2], 1),
+                                                       compression=dice_compression,
+                                                       compression_opts=dice_compression_opts)
+                        outprobs = out_f.create_dataset('probabilities',
+                                                       tuple(list(probs.shape) + [num_slices]),
+                                                       dtype=probs.dtype,
+                                                       chunks=(64, 64, 1),
+                                                       compression=dice_compression,
+                                                       compression_opts=dice_compression_opts)
+                    # each write fills whole chunks of the output
+                    outsegs[:, :, :, slice_idx] = segs
+                    outprobs[:, :, slice_idx] = probs
+                batch = None
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            out_f.close()
+
+            # move to final location
+            os.rename(output + '_partial', output)
+            print "Successfully wrote", output
+
+        except IOError as e:
+            print "I/O error({0}): {1}".format(e.errno, e.strerror)
+        except KeyboardInterrupt:
             pass
+        except:
+            print "Unexpected error:", sys.exc_info()[0]
+            if repeat_attempt_i == job_repeat_attempts:
+                pass
+
+    assert check_file(output), "Output file could not be verified after {0} attempts, exiting.".format(job_repeat_attempts)
+
+    # (an output that was already there wasn't measured by this run)
+    if repeat_attempt_i > 0:
+        telemetry.write()
 
-assert check_file(output), "Output file could not be verified after {0} attempts, exiting.".format(job_repeat_attempts)
+if __name__ == '__main__':
+    dice_block(*sys.argv[1:])
@@ -4,7 +4,14 @@ import os
 import subprocess
 import datetime
 import time
+import multiprocessing
+import json
+import math
+import resource
 from itertools import product
+import stage_runner
+import timer
+from job_state import JobStateStore
 from collections import defaultdict
 
 USE_SBATCH = True
@@ -23,9 +30,83 @@ MIN_TIME = 480
 MAX_JOBS_TO_SUBMIT = 100
 TIME_FACTOR = 1
 
+# Run stages that can be imported (Job.stage) in long-lived worker
+# processes, rather than starting python for every job
+IN_PROCESS_STAGES = True
+
+#Local (--local) settings, 0 to use the whole machine
+LOCAL_MAX_CORES = 0
+LOCAL_MAX_MEMORY_MB = 0
+LOCAL_POLL_INTERVAL = 1
+
+#Keep-running settings
+JOB_STATE_DB = 'job_state.sqlite'
+
+#Scheduling settings - jobs are run longest critical path first, and once a
+#stage has LEARN_MIN_RUNS recorded runs its time and memory requests come
+#from the longest run and largest peak memory seen, with some margin
+LEARN_RESOURCES = True
+LEARN_MIN_RUNS = 3
+LEARN_TIME_MARGIN = 1.5
+LEARN_MEMORY_MARGIN = 1.25
+
+#Stage report (--report) settings
+STAGE_REPORT = 'stage_report.json'
+
+#Dicing settings - without a diced copy of each block, window fusion and
+#cleanup read their block straight from the segmented sections
+DICE_BLOCKS = True
+
+#Read processes of dice_block.py and concatenate_joins.py.  These are the
+#stages' own settings (so set them in the settings file, which both read),
+#and size the jobs' processor requests.
+dice_read_processes = 4
+join_read_processes = 4
+
+#Window fusion batch settings - with FUSION_BATCH_SIZE > 1, each fusion job
+#fuses that many blocks, labeling the next block in another process while
+#CPLEX solves the current one
+FUSION_BATCH_SIZE = 1
+
+#Join concatenation settings
+JOIN_FANIN = 64
+
+def run_local_command(name, command):
+    # Runs in a local pool worker, logging like the cluster jobs do.
+    # Returns the exit code and peak memory in MB.
+    with open(os.path.join('logs', 'out.' + name), 'a') as out:
+        with open(os.path.join('logs', 'error.' + name), 'a') as err:
+            process = subprocess.Popen(command, stdout=out, stderr=err)
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            return process.returncode, usage.ru_maxrss / 1024.0
+
+def run_local_job(name, stage, args, command):
+    # Run a job in a local pool worker (in-process if it has a stage).
+    # Returns the exit code, wall time in seconds and peak memory in MB.
+    start = time.time()
+    if stage is not None:
+        returncode = stage_runner.run_stage(name, stage, args)
+        # (the worker's peak, so an upper bound for this job)
+        memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    else:
+        returncode, memory_mb = run_local_command(name, command)
+    return returncode, time.time() - start, memory_mb
+
+def local_resources():
+    cores = LOCAL_MAX_CORES if LOCAL_MAX_CORES > 0 else multiprocessing.cpu_count()
+    if LOCAL_MAX_MEMORY_MB > 0:
+        memory = LOCAL_MAX_MEMORY_MB
+    else:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    return cores, memory
+
 class Job(object):
     block_count = 0
     all_jobs = []
+    # (directory, module, function) for jobs that can run in-process, called
+    # with stage_args()
+    stage = None
 
     def __init__(self):
         # Allow for recovery if driver script fails - use deterministic job names.
@@ -39,6 +120,11 @@ class Job(object):
         self.try_count = 0
         Job.all_jobs.append(self)
 
+    @property
+    def stage_name(self):
+        # jobs of the same class share resource estimates
+        return self.__class__.__name__
+
     def get_done(self):
         if self.already_done:
             return True
@@ -48,6 +134,25 @@ class Job(object):
             return True
         return False
 
+    def read_telemetry(self):
+        # the record written next to the (first) output by timer.Telemetry
+        outputs = self.output if isinstance(self.output, (list, tuple)) else [self.output]
+        if len(outputs) == 0:
+            return None
+        try:
+            with open(timer.telemetry_path(outputs[0])) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def record_telemetry(self, state):
+        # learn from the job's measured run, if it wrote one
+        record = self.read_telemetry()
+        if record is None:
+            return False
+        state.record_run(self.name, self.stage_name, record['wall_seconds'], record['peak_memory_mb'])
+        return True
+
     def dependendencies_done(self):
         for d in self.dependencies:
             if not d.get_done():
@@ -129,6 +234,82 @@ class Job(object):
         else:
             return " && ".join("done(%s)" % d.name for d in self.dependencies if not d.get_done())
 
+    @classmethod
+    def prepare_schedule(cls, state=None):
+        # Fill in time and memory from past runs, then work out the
+        # critical path priority of every job: its own time plus the
+        # longest chain of jobs that depend on it.  Jobs are created after
+        # their dependencies, so one pass in reverse order is enough.
+        if LEARN_RESOURCES and state is not None:
+            estimates = state.stage_estimates()
+            for j in cls.all_jobs:
+                if j.stage_name not in estimates:
+                    continue
+                nruns, seconds, memory_mb = estimates[j.stage_name]
+                if nruns < LEARN_MIN_RUNS:
+                    continue
+                j.time = max(1, int(math.ceil(seconds * LEARN_TIME_MARGIN / 60)))
+                if memory_mb > 0:
+                    # memory is per processor
+                    j.memory = max(100, int(math.ceil(memory_mb * LEARN_MEMORY_MARGIN / j.processors)))
+
+        dependents = defaultdict(list)
+        for j in cls.all_jobs:
+            for d in j.dependencies:
+                dependents[d.job if isinstance(d, JobSplit) else d].append(j)
+        for j in reversed(cls.all_jobs):
+            j.priority = j.time + max([d.priority for d in dependents[j]] + [0])
+
+    @classmethod
+    def stage_report(cls):
+        # Summarize the telemetry of finished jobs by stage, in pipeline
+        # order, and save it to STAGE_REPORT
+        stage_names = []
+        records = defaultdict(list)
+        for j in cls.all_jobs:
+            record = j.read_telemetry()
+            if record is None:
+                continue
+            if j.stage_name not in records:
+                stage_names.append(j.stage_name)
+            records[j.stage_name].append((j, record))
+
+        report = []
+        print "{0:<20} {1:>6} {2:>10} {3:>10} {4:>8} {5:>10} {6:>10} {7:>10} {8:>10}".format(
+            'stage', 'jobs', 'mean wall', 'max wall', 'cpu use', 'peak MB', 'asked MB', 'read GB', 'write GB')
+        for stage_name in stage_names:
+            stage_records = records[stage_name]
+            walls = [r['wall_seconds'] for j, r in stage_records]
+            # fraction of the requested processors kept busy
+            cpu_use = sum(r['cpu_seconds'] for j, r in stage_records) / max(sum(r['wall_seconds'] * j.processors for j, r in stage_records), 1e-6)
+            phases = defaultdict(float)
+            for j, r in stage_records:
+                for name, seconds in r['phases']:
+                    phases[name] += seconds
+            summary = {'stage': stage_name,
+                       'jobs': len(stage_records),
+                       'mean_wall_seconds': sum(walls) / len(walls),
+                       'max_wall_seconds': max(walls),
+                       'requested_seconds': max(j.time for j, r in stage_records) * 60,
+                       'cpu_use': cpu_use,
+                       # (None when a job's pool workers weren't measured)
+                       'peak_memory_mb': max(r['peak_memory_mb'] or 0 for j, r in stage_records),
+                       'requested_memory_mb': max(j.memory * j.processors for j, r in stage_records),
+                       'read_bytes': sum(r['read_bytes'] or 0 for j, r in stage_records),
+                       'written_bytes': sum(r['written_bytes'] or 0 for j, r in stage_records),
+                       'phase_seconds': dict(phases)}
+            report.append(summary)
+            print "{0:<20} {1:>6} {2:>10.1f} {3:>10.1f} {4:>8.2f} {5:>10.0f} {6:>10} {7:>10.2f} {8:>10.2f}".format(
+                stage_name, summary['jobs'], summary['mean_wall_seconds'], summary['max_wall_seconds'], cpu_use,
+                summary['peak_memory_mb'], summary['requested_memory_mb'],
+                summary['read_bytes'] / 2.0 ** 30, summary['written_bytes'] / 2.0 ** 30)
+            for name, seconds in sorted(phases.items(), key=lambda p: -p[1]):
+                print "    {0:<30} {1:>10.1f}s total".format(name, seconds)
+
+        with open(STAGE_REPORT, 'w') as f:
+            json.dump(report, f, indent=1)
+        print "Wrote stage report for {0} stages to {1}.".format(len(report), STAGE_REPORT)
+
     @classmethod
     def run_all(cls):
         for j in cls.all_jobs:
@@ -209,12 +390,23 @@ class Job(object):
             full_command += "cd $PBS_O_WORKDIR\ndate\n"
 
         # Generate job block commands
-        for job_block in job_block_list:
-            block_commands = ''
-            for j in job_block:
-                block_commands += '{0} &\n'.format(' '.join(j.command()))
-                print j.name
-            full_command += '{0}wait\ndate\n'.format(block_commands)
+        if IN_PROCESS_STAGES and all(j.stage is not None for job_block in job_block_list for j in job_block):
+            # One python process runs every job, on a pool of workers
+            jobs_file = os.path.join('logs', 'jobs.' + block_name + '.json')
+            with open(jobs_file, 'w') as f:
+                json.dump([[(j.name, j.stage, j.stage_args()) for j in job_block] for job_block in job_block_list], f)
+            for job_block in job_block_list:
+                for j in job_block:
+                    print j.name
+            full_command += 'python {0} {1} {2}\ndate\n'.format(
+                os.path.join(os.environ['CONNECTOME'], 'Control', 'stage_runner.py'), jobs_file, required_cores)
+        else:
+            for job_block in job_block_list:
+                block_commands = ''
+                for j in job_block:
+                    block_commands += '{0} &\n'.format(' '.join(j.command()))
+                    print j.name
+                full_command += '{0}wait\ndate\n'.format(block_commands)
 
         # # Test job ids
         # for job_block in job_block_list:
@@ -252,6 +444,9 @@ class Job(object):
         required_full_memory = 0
         required_full_time = 0
         required_block_time = 0
+        # Longest critical path first.  A dependency always has a higher
+        # priority than the jobs depending on it, so this keeps them in order.
+        runnable_jobs = sorted(runnable_jobs, key=lambda j: -j.priority)
         for j in runnable_jobs:
 
             # Make sure output directories exist
@@ -326,9 +521,98 @@ class Job(object):
 
         return submitted_job_blocks
 
+    @classmethod
+    def local_run_all(cls):
+        # Run the whole job graph on this machine, on a pool of worker
+        # processes.  Jobs start as soon as their dependencies are done, as
+        # long as their processors and memory (per processor, as for
+        # sbatch) fit in what is not used by running jobs.  A job too big
+        # for the machine runs when nothing else is.  Finished outputs are
+        # skipped, so an interrupted run can be resumed.
+        max_cores, max_memory = local_resources()
+        print "Running locally on {0} cores, {1}MB memory.".format(max_cores, max_memory)
+
+        if not os.path.isdir('logs'):
+            os.mkdir('logs')
+
+        state = JobStateStore(JOB_STATE_DB)
+        cls.prepare_schedule(state)
+
+        pool = multiprocessing.Pool(max_cores)
+        waiting = sorted([j for j in cls.all_jobs if not j.get_done()], key=lambda j: -j.priority)
+        running = {}
+        used_cores = 0
+        used_memory = 0
+        complete = 0
+        failed = []
+
+        while len(waiting) > 0 or len(running) > 0:
+
+            # Collect finished jobs
+            for j in running.keys():
+                result, cores, memory = running[j]
+                if not result.ready():
+                    continue
+                del running[j]
+                used_cores -= cores
+                used_memory -= memory
+                returncode, seconds, memory_mb = result.get()
+                if returncode == 0 and j.get_done():
+                    complete += 1
+                    print "DONE", j.name
+                    if not j.record_telemetry(state):
+                        state.record_run(j.name, j.stage_name, seconds, memory_mb)
+                    state.commit()
+                elif j.try_count >= MAX_TRIES:
+                    print "FAILED", j.name
+                    failed.append(j)
+                else:
+                    print "RETRY", j.name
+                    waiting.append(j)
+
+            # Start any runnable jobs that fit
+            still_waiting = []
+            for j in waiting:
+                if j.get_done():
+                    continue
+                cores = min(j.processors, max_cores)
+                memory = min(j.memory * j.processors, max_memory)
+                if (j.dependendencies_done() and
+                    (len(running) == 0 or
+                     (used_cores + cores <= max_cores and used_memory + memory <= max_memory))):
+                    for f in (j.output if isinstance(j.output, (list, tuple)) else [j.output]):
+                        if not os.path.isdir(os.path.dirname(f)):
+                            os.mkdir(os.path.dirname(f))
+                    print "RUN", j.name
+                    print " ".join(j.command())
+                    j.try_count += 1
+                    if IN_PROCESS_STAGES and j.stage is not None:
+                        result = pool.apply_async(run_local_job, (j.name, j.stage, j.stage_args(), None))
+                    else:
+                        result = pool.apply_async(run_local_job, (j.name, None, None, j.command()))
+                    running[j] = (result, cores, memory)
+                    used_cores += cores
+                    used_memory += memory
+                else:
+                    still_waiting.append(j)
+            waiting = still_waiting
+
+            if len(running) == 0:
+                # nothing left can run (dependencies failed)
+                break
+
+            time.sleep(LOCAL_POLL_INTERVAL)
+
+        pool.close()
+        pool.join()
+
+        print "Completed {0} job{1}, {2} failed, {3} not run.".format(
+            complete, '' if complete == 1 else 's', len(failed), len(waiting))
+
     @classmethod
     def multicore_run_all(cls):
-        multicore_run_list(cls.all_jobs)
+        cls.prepare_schedule(JobStateStore(JOB_STATE_DB))
+        cls.multicore_run_list(cls.all_jobs)
 
     @classmethod
     def multicore_keep_running(cls):
@@ -336,6 +620,9 @@ class Job(object):
         cancelled_jobs = {}
         cancelled_requeue_iters = 5
         submitted_job_blocks = {}
+        state = JobStateStore(JOB_STATE_DB)
+        cls.prepare_schedule(state)
+        tracker = JobTracker(cls.all_jobs, state)
 
         while not all_jobs_complete:
 
@@ -427,18 +714,22 @@ class Job(object):
 
             #print '== {0} running jobs.'.format(len(pending_running_complete_jobs))
 
-            # Make a list of runnable jobs
+            # Make a list of runnable jobs, only checking jobs that have
+            # finished, failed or had a dependency finish since last time
+            tracker.update(pending_running_complete_jobs)
             run_count = 0
             block_count = 0
-            runnable_jobs = []
-            for j in cls.all_jobs:
-                if j.name not in pending_running_complete_jobs and not j.get_done() and j.dependendencies_done():
-                    runnable_jobs.append(j)
-                    run_count += 1
+            runnable_jobs = tracker.runnable(pending_running_complete_jobs)
+            run_count += len(runnable_jobs)
 
             new_job_blocks = Job.multicore_run_list(runnable_jobs)
             block_count += len(new_job_blocks)
             submitted_job_blocks.update(new_job_blocks)
+            for job_block_list in new_job_blocks.values():
+                for job_list in job_block_list:
+                    for j in job_list:
+                        tracker.submitted(j)
+            tracker.commit()
 
             print 'Found {0} pending, {1} running, {2} complete, {3} failed, {4} cancelled, {5} timeout, {6} unknown status and {7} non-matching job blocks.'.format(
                 pending, running, complete, failed, cancelled, timeout, other_status, non_matching)
@@ -457,15 +748,16 @@ class Job(object):
         all_jobs_complete = False
         cancelled_jobs = {}
         cancelled_requeue_iters = 3
-        while not all_jobs_complete:
+        state = JobStateStore(JOB_STATE_DB)
+        cls.prepare_schedule(state)
+        tracker = JobTracker(cls.all_jobs, state)
+        all_job_names = tracker.jobs_by_name
+        sacct_recorded = set()
 
-            all_job_names = {}
-            # Generate dictionary of jobs
-            for j in cls.all_jobs:
-                all_job_names[j.name] = True
+        while not all_jobs_complete:
 
             # Find running jobs
-            sacct_output = subprocess.check_output(['sacct', '-n', '-o', 'JobID,JobName%100,State%20'])
+            sacct_output = subprocess.check_output(['sacct', '-n', '-o', 'JobID,JobName%100,ElapsedRaw,State%20'])
 
             pending_running_complete_jobs = {}
             pending = 0
@@ -485,7 +777,18 @@ class Job(object):
 
                 job_id = job_split[0]
                 job_name = job_split[1]
-                job_status = ' '.join(job_split[2:])
+                job_elapsed = job_split[2]
+                job_status = ' '.join(job_split[3:])
+
+                # learn run times of completed jobs that didn't measure
+                # themselves (their telemetry is recorded when they finish,
+                # under the same name)
+                if (job_status == 'COMPLETED' and job_name in all_job_names and job_elapsed.isdigit() and
+                    job_name not in sacct_recorded):
+                    sacct_recorded.add(job_name)
+                    sacct_job = all_job_names[job_name]
+                    if sacct_job.read_telemetry() is None:
+                        state.record_run(sacct_job.name, sacct_job.stage_name, int(job_elapsed))
                 
                 if job_name in all_job_names:
                     if job_status in ['PENDING', 'RUNNING', 'COMPLETED']:
@@ -539,10 +842,15 @@ class Job(object):
                 elif job_name not in ['batch', 'true', 'prolog']:
                     non_matching += 1
 
+            # Only check jobs that have finished, failed or had a dependency
+            # finish since last time
+            tracker.update(pending_running_complete_jobs)
             run_count = 0
-            for j in cls.all_jobs:
-                if j.name not in pending_running_complete_jobs and j.dependendencies_done():
-                    run_count += j.run()
+            for j in tracker.runnable(pending_running_complete_jobs):
+                if j.run():
+                    run_count += 1
+                    tracker.submitted(j)
+            tracker.commit()
 
             print 'Found {0} pending, {1} running, {2} complete, {3} failed, {4} cancelled, {5} timeout, {6} unknown status and {7} non-matching jobs.'.format(
                 pending, running, complete, failed, cancelled, timeout, other_status, non_matching)
@@ -585,6 +893,80 @@ class JobSplit(object):
         self.job.jobid = value
     
 
+class FusedBlockPart(JobSplit):
+    '''one block of a FusedBlockBatch, looking like a FusedBlock'''
+    @property
+    def block(self):
+        return self.job.blocks[self.idx]
+
+    @property
+    def global_block_number(self):
+        return self.job.global_block_numbers[self.idx]
+
+class JobTracker(object):
+    '''Tracks which jobs need checking in the keep-running loops.
+
+    Finished jobs are recorded in a JobStateStore, and skipped on later passes
+    (and by later drivers).  Each pass only looks at jobs that were submitted
+    (to see if they finished), and jobs that became ready to run because a
+    dependency finished, rather than every job.
+    '''
+    def __init__(self, jobs, state):
+        self.state = state
+        self.jobs_by_name = dict((j.name, j) for j in jobs)
+        loaded = state.load_done(jobs)
+        print "Loaded {0} finished jobs from job state.".format(loaded)
+
+        self.dependents = defaultdict(list)
+        for j in jobs:
+            for d in j.dependencies:
+                self.dependents[d.job if isinstance(d, JobSplit) else d].append(j)
+
+        self.unfinished = set(j for j in jobs if not j.already_done)
+        # everything unfinished is checked on the first pass
+        self.ready = set(self.unfinished)
+        self.in_flight = set()
+
+    def finished(self, job):
+        self.unfinished.discard(job)
+        self.ready.discard(job)
+        self.in_flight.discard(job)
+        self.state.mark_done(job)
+        job.record_telemetry(self.state)
+        self.ready.update(d for d in self.dependents[job] if d in self.unfinished)
+
+    def submitted(self, job):
+        self.ready.discard(job)
+        self.in_flight.add(job)
+        self.state.mark_submitted(job)
+
+    def update(self, active_names):
+        # check submitted jobs, requeueing any that stopped without output
+        for j in list(self.in_flight):
+            if j.get_done():
+                self.finished(j)
+            elif j.name not in active_names:
+                self.in_flight.discard(j)
+                self.ready.add(j)
+
+    def runnable(self, active_names):
+        runnable = []
+        for j in list(self.ready):
+            if j.name in active_names:
+                # already queued (by an earlier driver)
+                self.submitted(j)
+            elif j.get_done():
+                self.finished(j)
+            elif j.dependendencies_done():
+                runnable.append(j)
+            else:
+                # wait for a dependency to finish
+                self.ready.discard(j)
+        return sorted(runnable, key=lambda j: -j.priority)
+
+    def commit(self):
+        self.state.commit()
+
 class Reassemble(Job):
     '''reassemble a diced job'''
     def __init__(self, dataset, output_sizes, joblist, output):
@@ -660,6 +1042,9 @@ class ClassifySegment_Image(Job):
                 self.raw_image, self.classifier_file, self.stump_image, self.prob_file, self.output]
 
 class Block(Job):
+    # (no stage - dice_block.py starts its own pool of readers, which it
+    # can't do in a stage_runner worker)
+
     def __init__(self, segmented_slices, indices, *args):
         Job.__init__(self)
         self.already_done = False
@@ -667,12 +1052,21 @@ class Block(Job):
         self.dependencies = segmented_slices
         self.memory = 500
         self.time = 30
-        self.output = os.path.join('bigdicedblocks', 'block_%d_%d_%d.hdf5' % indices)
+        if DICE_BLOCKS:
+            self.processors = max(dice_read_processes, 1)
+            self.output = os.path.join('bigdicedblocks', 'block_%d_%d_%d.hdf5' % indices)
+        else:
+            # just a description of the block
+            self.time = 1
+            self.output = os.path.join('bigdicedblocks', 'block_%d_%d_%d.json' % indices)
         self.args = [str(a) for a in args] + [self.output]
         #self.already_done = os.path.exists(self.output)
 
+    def stage_args(self):
+        return self.args + [s.output for s in self.segmented_slices]
+
     def command(self):
-        return ['python', os.path.join(os.environ['CONNECTOME'], 'Control', 'dice_block.py')] + self.args + [s.output for s in self.segmented_slices]
+        return ['python', os.path.join(os.environ['CONNECTOME'], 'Control', 'dice_block.py')] + self.stage_args()
 
 class FusedBlock(Job):
     def __init__(self, block, indices, global_block_number):
@@ -697,7 +1091,38 @@ class FusedBlock(Job):
                 str(self.global_block_number),
                 self.output]
 
+class FusedBlockBatch(Job):
+    def __init__(self, blocks, indices, global_block_numbers):
+        Job.__init__(self)
+        self.already_done = False
+        self.blocks = blocks
+        self.global_block_numbers = global_block_numbers
+        self.dependencies = blocks
+        # CPLEX's threads, plus the labeling process
+        self.processors = 4 + 1
+        # 64GB for the block being solved, 4GB for the next one's labeling,
+        # and as much again for its overlaps, waiting to be solved
+        self.memory = (64000 + 4000 + 4000) / self.processors
+        # (learned from the record window_fusion_cpx.py writes for the whole
+        # batch, next to the first output)
+        self.time = 480 * len(blocks)
+        self.indices = indices
+        self.output = tuple(os.path.join('bigfusedblocks', 'fusedblock_%d_%d_%d.hdf5' % idxs) for idxs in indices)
+
+    def parts(self):
+        return [FusedBlockPart(self, idx) for idx in range(len(self.blocks))]
+
+    def command(self):
+        args = []
+        for block, global_block_number, output in zip(self.blocks, self.global_block_numbers, self.output):
+            args += [block.output, str(global_block_number), output]
+        return ['python',
+                os.path.join(os.environ['CONNECTOME'], 'WindowFusion', 'window_fusion_cpx.py'),
+                '--batch'] + args
+
 class CleanBlock(Job):
+    stage = ('Cleanup', 'clean_block', 'clean_block')
+
     def __init__(self, fusedblock):
         Job.__init__(self)
         self.already_done = False
@@ -713,10 +1138,15 @@ class CleanBlock(Job):
         self.output = os.path.join('cleanedblocks', 'block_%d_%d_%d.hdf5' % self.indices)
         #self.already_done = os.path.exists(self.output)
 
+    def stage_args(self):
+        return [self.inputlabels, self.inputprobs, self.output]
+
     def command(self):
-        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'clean_block.sh'), self.inputlabels, self.inputprobs, self.output]
+        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'clean_block.sh')] + self.stage_args()
 
 class PairwiseMatching(Job):
+    stage = ('PairwiseMatching', 'pairwise_multimatch', 'pairwise_multimatch')
+
     def __init__(self, fusedblock1, fusedblock2, direction, even_or_odd, halo_width):
         Job.__init__(self)
         self.direction = direction
@@ -725,25 +1155,34 @@ class PairwiseMatching(Job):
         self.halo_width = halo_width
         self.indices = (fusedblock1.indices, fusedblock2.indices)
         self.dependencies = [fusedblock1, fusedblock2]
+        # matching only holds the overlapping slabs in memory
         #self.memory = 16000
-        self.memory = 8000
-        #self.memory = 4000
+        #self.memory = 8000
+        self.memory = 2000
         self.time = 60
         outdir = 'pairwise_matches_%s_%s' % (['X', 'Y', 'Z',][direction], even_or_odd)
         self.output = (os.path.join(outdir, os.path.basename(fusedblock1.output)),
                        os.path.join(outdir, os.path.basename(fusedblock2.output)))
         #self.already_done = os.path.exists(self.output[0]) and os.path.exists(self.output[1])
 
-    def command(self):
-        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'pairwise_match_labels.sh')] + [d.output for d in self.dependencies] + \
+    def stage_args(self):
+        return [d.output for d in self.dependencies] + \
             [str(self.direction + 1), # matlab
              str(self.halo_width)] + list(self.output)
 
+    def command(self):
+        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'pairwise_match_labels.sh')] + self.stage_args()
+
 class JoinConcatenation(Job):
+    # (no stage - concatenate_joins.py starts its own pool of readers, which
+    # it can't do in a stage_runner worker)
+
     def __init__(self, outfilename, inputs):
         Job.__init__(self)
         self.already_done = False
         self.dependencies = inputs
+        # concatenate_joins.py reads its inputs with join_read_processes processes
+        self.processors = max(join_read_processes, 1)
         self.memory = 1000
         self.time = 60
         self.output = os.path.join('joins', outfilename)
@@ -769,12 +1208,15 @@ class GlobalRemap(Job):
         return [os.path.join(os.environ['CONNECTOME'], 'Control', 'create_global_map.sh'), self.joinfile, self.output]
 
 class RemapBlock(Job):
+    stage = ('Relabeling', 'remap_block', 'remap_block')
+
     def __init__(self, blockjob, build_remap_job, indices):
         Job.__init__(self)
         self.already_done = False
         self.dependencies = [blockjob, build_remap_job]
-        #self.memory = 2000
-        self.memory = 4000
+        # remap_block.py streams chunk by chunk, so only the remap table is held in memory
+        self.memory = 2000
+        #self.memory = 4000
         #self.memory = 8000
         self.time = 60
         self.inputfile = blockjob.output
@@ -783,8 +1225,11 @@ class RemapBlock(Job):
         self.output = os.path.join('relabeledblocks', 'block_%d_%d_%d.hdf5' % indices)
         #self.already_done = os.path.exists(self.output)
 
+    def stage_args(self):
+        return [self.inputfile, self.mapfile, self.output]
+
     def command(self):
-        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'remap_block.sh'), self.inputfile, self.mapfile, self.output]
+        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'remap_block.sh')] + self.stage_args()
 
 class CopyImage(Job):
     def __init__(self, input, idx):
@@ -800,6 +1245,8 @@ class CopyImage(Job):
         return ['/bin/cp', self.inputfile, self.output]
 
 class ExtractLabelPlane(Job):
+    stage = ('Relabeling', 'extract_label_plane', 'extract_label_plane')
+
     def __init__(self, zplane, xy_halo, remapped_blocks, zoffset, image_size, xy_block_size):
         Job.__init__(self)
         self.already_done = False
@@ -820,10 +1267,13 @@ class ExtractLabelPlane(Job):
             yield str(block.indices[1] * self.xy_block_size)
             yield block.output
 
-    def command(self):
-        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'extract_label_plane.sh'), self.output, str(self.image_size), str(self.zoffset), str(self.xy_halo)] + \
+    def stage_args(self):
+        return [self.output, str(self.image_size), str(self.zoffset), str(self.xy_halo)] + \
             list(self.generate_args())
 
+    def command(self):
+        return [os.path.join(os.environ['CONNECTOME'], 'Control', 'extract_label_plane.sh')] + self.stage_args()
+
 class ExtractOverlayPlane(Job):
     def __init__(self, zplane, xy_halo, remapped_blocks, zoffset, image_size, xy_block_size, input_image_path):
         Job.__init__(self)
@@ -871,6 +1321,16 @@ def dice(job_builder, args, full_sizes, core_sizes, halo_sizes):
         jobs.append(job_builder(*(args + lovals + hivals + locore + hicore)))
     return jobs
 
+def join_tree(outfilename, inputs, fanin):
+    # Concatenate joins as a tree, so no single job reads more than fanin
+    # files.  Each level writes deduplicated partial merge tables.
+    level = 0
+    while len(inputs) > fanin:
+        inputs = [JoinConcatenation('%s_L%d_%d' % (outfilename, level, idx), inputs[lo:lo + fanin])
+                  for idx, lo in enumerate(range(0, len(inputs), fanin))]
+        level += 1
+    return JoinConcatenation(outfilename, inputs)
+
 
 ###############################
 # Driver
@@ -932,8 +1392,17 @@ if __name__ == '__main__':
 
     # Window fuse all blocks
     # Generate block id based on on block index with z as most significant (allows additional slabs to be added later)
-    fused_blocks = dict((idxs, FusedBlock(blocks[idxs], idxs,
-        idxs[0] + idxs[1] * nblocks_x + idxs[2] * nblocks_x * nblocks_y)) for idxs in block_order)
+    def global_block_number(idxs):
+        return idxs[0] + idxs[1] * nblocks_x + idxs[2] * nblocks_x * nblocks_y
+    if FUSION_BATCH_SIZE > 1:
+        fused_blocks = {}
+        for batch_start in range(0, len(block_order), FUSION_BATCH_SIZE):
+            batch_order = block_order[batch_start:batch_start + FUSION_BATCH_SIZE]
+            batch = FusedBlockBatch([blocks[idxs] for idxs in batch_order], batch_order,
+                                    [global_block_number(idxs) for idxs in batch_order])
+            fused_blocks.update(zip(batch_order, batch.parts()))
+    else:
+        fused_blocks = dict((idxs, FusedBlock(blocks[idxs], idxs, global_block_number(idxs))) for idxs in block_order)
 
     # Cleanup all blocks (remove small or completely enclosed segments)
     cleaned_blocks = dict((idxs, CleanBlock(fused_blocks[idxs])) for idxs in block_order)
@@ -962,14 +1431,10 @@ if __name__ == '__main__':
                         cleaned_blocks[neighbor_idx] = JobSplit(pw, 1)
 
     # Contatenate the joins from all the blocks to a single file, for building
-    # the global remap.  Work first on XY planes, to add some parallelism and
-    # limit number of command arguments.
-    plane_joins_lists = {}
-    for idxs in block_order:
-        plane_joins_lists[idxs[2]] = plane_joins_lists.get(idxs[2], []) + [cleaned_blocks[idxs]]
-    plane_join_jobs = [JoinConcatenation('concatenate_Z_%d' % idx, plane_joins_lists[idx])
-                       for idx in plane_joins_lists]
-    full_join = JoinConcatenation('concatenate_full', plane_join_jobs)
+    # the global remap.  Work as a tree of at most JOIN_FANIN inputs per job,
+    # to add some parallelism and limit number of command arguments.  Blocks
+    # are in Z-major order, so neighbouring blocks are joined together.
+    full_join = join_tree('concatenate_full', [cleaned_blocks[idxs] for idxs in block_order], JOIN_FANIN)
 
     # build the global remap
     remap = GlobalRemap('globalmap', full_join)
@@ -1013,20 +1478,28 @@ if __name__ == '__main__':
     if '--local' in sys.argv:
         RUN_LOCAL = True
         sys.argv.remove('--local')
-    if len(sys.argv) == 3:
-        Job.run_all()
+    if '--report' in sys.argv:
+        # Summarize the measured time and memory of finished jobs by stage
+        Job.stage_report()
+    elif len(sys.argv) == 3:
+        if RUN_LOCAL:
+            Job.local_run_all()
+        else:
+            Job.run_all()
     elif '-k' in sys.argv or '--keeprunning' in sys.argv:
         # Monitor job status and requeue as necessary
         Job.keep_running()
     elif '-m' in sys.argv or '--multicore' in sys.argv:
         if RUN_LOCAL:
-            print "ERROR: --local cannot be used with --multicore (not yet implemented)."
+            # Pack jobs onto the cores of this machine
+            Job.local_run_all()
         else:
             # Bundle jobs for multicore nodes
             Job.multicore_run_all()
     elif '-mk' in sys.argv or '--multicore-keeprunning' in sys.argv:
         if RUN_LOCAL:
-            print "ERROR: --local cannot be used with --multicore-keeprunning (not yet implemented)."
+            # Runs until everything is done anyway
+            Job.local_run_all()
         else:
             # Bundle jobs for multicore nodes
             Job.multicore_keep_running()
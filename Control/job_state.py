@@ -0,0 +1,59 @@
+import json
+import sqlite3
+import time
+
+# On-disk record of job status for the driver's keep-running loops, so a
+# restarted driver (or the next pass) doesn't have to stat the outputs of
+# every finished job again.  Delete the database to force a full recheck.
+
+class JobStateStore(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                        '(name TEXT PRIMARY KEY, status TEXT, outputs TEXT, jobid TEXT, updated REAL)')
+        # Finished runs, for learning how much time and memory each stage needs
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs '
+                        '(run TEXT PRIMARY KEY, stage TEXT, seconds REAL, memory_mb REAL)')
+        self.db.commit()
+
+    @staticmethod
+    def outputs_string(job):
+        outputs = job.output if isinstance(job.output, (list, tuple)) else [job.output]
+        return json.dumps(list(outputs))
+
+    def load_done(self, jobs):
+        # Mark jobs recorded as done, if they still have the same outputs
+        done = dict(self.db.execute("SELECT name, outputs FROM jobs WHERE status = 'done'"))
+        count = 0
+        for j in jobs:
+            if done.get(j.name) == self.outputs_string(j):
+                j.already_done = True
+                count += 1
+        return count
+
+    def set_status(self, job, status):
+        self.db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)',
+                        (job.name, status, self.outputs_string(job), job.jobid, time.time()))
+
+    def mark_done(self, job):
+        self.set_status(job, 'done')
+
+    def mark_submitted(self, job):
+        self.set_status(job, 'submitted')
+
+    def commit(self):
+        self.db.commit()
+
+    def record_run(self, run, stage, seconds, memory_mb=None):
+        # run is a cluster job id or job name, so seeing the same run again
+        # (e.g. in every sacct listing) only records it once
+        self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                        (run, stage, seconds, memory_mb))
+
+    def stage_estimates(self):
+        # {stage: (number of runs, longest run in seconds, largest peak memory in MB)}
+        estimates = {}
+        for stage, nruns, seconds, memory_mb in self.db.execute(
+                'SELECT stage, COUNT(*), MAX(seconds), MAX(memory_mb) FROM runs GROUP BY stage'):
+            estimates[stage] = (nruns, seconds, memory_mb or 0)
+        return estimates
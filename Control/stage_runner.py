@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import traceback
+import multiprocessing
+
+# Runs pipeline stages in-process, rather than starting a new interpreter
+# for each job.  A stage is (directory under $CONNECTOME, module, function),
+# and the function is called with the job's arguments.  Each worker imports
+# a stage module (and numpy, h5py, etc.) once, and then reuses it for every
+# job of that stage it runs.
+#
+# Usage: python stage_runner.py JOBS_FILE NPROCESSES
+#   JOBS_FILE holds a JSON list of job blocks, each a list of
+#   [name, stage, args] jobs.  The jobs in a block are run in parallel, and
+#   the blocks one after another.
+
+# stage modules imported so far, by (directory, module)
+stage_modules = {}
+
+def import_stage(directory, module_name):
+    # Each directory has its own copies of the shared helpers (timer.py,
+    # label_index.py, ...), so a stage is imported with only its directory
+    # on the path, and with the modules imported from the other directories
+    # (including the driver's) out of sys.modules.  Stages already imported
+    # keep the helpers they were imported with.
+    key = (directory, module_name)
+    if key not in stage_modules:
+        connectome = os.path.abspath(os.environ['CONNECTOME'])
+        path = os.path.join(connectome, directory)
+        sys.path[:] = [p for p in sys.path
+                       if os.path.dirname(os.path.abspath(p)) != connectome]
+        sys.path.insert(0, path)
+        for name, module in list(sys.modules.items()):
+            module_file = getattr(module, '__file__', None)
+            if module_file is None or name in ('__main__', __name__):
+                continue
+            module_dir = os.path.dirname(os.path.abspath(module_file))
+            if os.path.dirname(module_dir) == connectome and module_dir != path:
+                del sys.modules[name]
+        stage_modules[key] = __import__(module_name)
+    return stage_modules[key]
+
+def run_stage(name, stage, args):
+    # Run one job, logging to logs/out.NAME and logs/error.NAME like a
+    # separate process would.  Returns 0 on success.
+    directory, module_name, function_name = stage
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout = os.dup(1)
+    saved_stderr = os.dup(2)
+    out = open(os.path.join('logs', 'out.' + name), 'a')
+    err = open(os.path.join('logs', 'error.' + name), 'a')
+    os.dup2(out.fileno(), 1)
+    os.dup2(err.fileno(), 2)
+
+    try:
+        module = import_stage(directory, module_name)
+        getattr(module, function_name)(*args)
+        return 0
+    except SystemExit as e:
+        return 0 if e.code in (None, 0) else 1
+    except:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+        out.close()
+        err.close()
+
+if __name__ == '__main__':
+    jobs_file = sys.argv[1]
+    nprocesses = int(sys.argv[2])
+
+    job_block_list = json.load(open(jobs_file))
+
+    if not os.path.isdir('logs'):
+        os.mkdir('logs')
+
+    pool = multiprocessing.Pool(nprocesses)
+    failed = 0
+    for job_block in job_block_list:
+        results = [(name, pool.apply_async(run_stage, (name, stage, args))) for name, stage, args in job_block]
+        for name, result in results:
+            if result.get() != 0:
+                print "FAILED", name
+                failed += 1
+            else:
+                print "DONE", name
+    pool.close()
+    pool.join()
+
+    sys.exit(1 if failed > 0 else 0)
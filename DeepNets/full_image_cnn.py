@@ -9,9 +9,14 @@ from numpy.fft import irfftn
 import mahotas
 import time
 import h5py
+from collections import OrderedDict
 
 VALID_SIZE_CROP = False
 
+# Filter spectra kept per convolution layer, one for each FFT size seen
+# (blocks at the image edge are smaller, so need their own)
+FFT_CACHE_SIZE = 4
+
 def _centered(arr, newsize):
     # Return the center newsize portion of the array.
     newsize = np.asarray(newsize)
@@ -30,7 +35,7 @@ class ConvolutionMaxpoolLayer(object):
         self.maxpool_size = maxpool_size
         self.stride_in = stride_in
         self.stride_out = stride_in * maxpool_size
-        self.prev_conv_size = 0
+        self.fft_cache = OrderedDict()
 
         if W == []:
             self.W = (np.float32(np.random.random((nkernels, ninputs, kernel_size, kernel_size))) - 0.5) * weight_init * 2
@@ -42,6 +47,18 @@ class ConvolutionMaxpoolLayer(object):
         else:
             self.b = b
 
+    def filter_fft(self, fsize):
+        # Spectra of all filters at this FFT size, with the least recently
+        # used size dropped when the cache is full
+        if fsize in self.fft_cache:
+            Wfft = self.fft_cache.pop(fsize)
+        else:
+            Wfft = rfftn(self.W, fsize, axes=(2, 3)).astype(np.complex64)
+            if len(self.fft_cache) >= FFT_CACHE_SIZE:
+                self.fft_cache.popitem(last=False)
+        self.fft_cache[fsize] = Wfft
+        return Wfft
+
     def apply_layer(self, input_image):
         # Calculate feed-forward result
         assert(input_image.shape[0] == self.ninputs)
@@ -66,67 +83,56 @@ class ConvolutionMaxpoolLayer(object):
         for stridex in range(self.stride_in):
             for stridey in range(self.stride_in):
 
-                same_fft_size = True
-
-                for filteri in range(self.nkernels):
-
-                    # Apply convolution
-
-                    if VALID_SIZE_CROP:
-                        stride_shape = (
-                            len(np.arange(stridex, input_image.shape[1] - self.kernel_size + 1, self.stride_in)),
-                            len(np.arange(stridey, input_image.shape[2] - self.kernel_size + 1, self.stride_in)))
-                    else:
-                        stride_shape = (
-                            len(np.arange(stridex, input_image.shape[1], self.stride_in)),
-                            len(np.arange(stridey, input_image.shape[2], self.stride_in)))
-
-                    #conv_result = np.zeros(((output_size[0] + stridex) / self.stride_in, (output_size[1] + stridey) / self.stride_in), dtype=np.float32)
-                    conv_result = np.zeros((stride_shape[0], stride_shape[1]), dtype=np.float32)
-
-                    for channeli in range(self.ninputs):
-
-                        # Space domain convolution
-                        # conv_result = conv_result + convolve2d(
-                        #    input_image[channeli, stridex::self.stride_in, stridey::self.stride_in].squeeze(),
-                        #    self.W[filteri,channeli,:,:].squeeze(),
-                        #    mode='same')
-                        #    #mode='valid')
+                # Apply convolution
 
-                        # FFT convolution
-                        #conv_result = conv_result + fftconvolve(
-                        #    input_image[channeli, stridex::self.stride_in, stridey::self.stride_in].squeeze(),
-                        #    self.W[filteri,channeli,:,:].squeeze(),
-                        #    mode='same')
-
-                        # FFT convolution (cache filter transformations)
-                        convolve_image = input_image[channeli, stridex::self.stride_in, stridey::self.stride_in].squeeze()
-                        conv_size = (self.kernel_size + convolve_image.shape[0] - 1, self.kernel_size + convolve_image.shape[1] - 1)
-
-                        fsize = 2 ** np.ceil(np.log2(conv_size)).astype(int)
-                        fslice = tuple([slice(0, int(sz)) for sz in conv_size])
-
-                        if same_fft_size and conv_size == self.prev_conv_size:
-                            fft_result = irfftn(rfftn(convolve_image, fsize) * self.Wfft[filteri,channeli,:,:], fsize)[fslice].copy()
-                        else:
-                            if same_fft_size:
-                                self.Wfft = np.zeros((self.nkernels, self.ninputs, fsize[0], fsize[1]//2+1), np.complex64)
-                                same_fft_size = False
-                                self.prev_conv_size = conv_size
-
-                            filter_fft = rfftn(self.W[filteri,channeli,:,:].squeeze(), fsize)
-                            fft_result = irfftn(rfftn(convolve_image, fsize) * filter_fft, fsize)[fslice].copy()
-
-                            self.Wfft[filteri,channeli,:,:] = filter_fft
+                if VALID_SIZE_CROP:
+                    stride_shape = (
+                        len(np.arange(stridex, input_image.shape[1] - self.kernel_size + 1, self.stride_in)),
+                        len(np.arange(stridey, input_image.shape[2] - self.kernel_size + 1, self.stride_in)))
+                else:
+                    stride_shape = (
+                        len(np.arange(stridex, input_image.shape[1], self.stride_in)),
+                        len(np.arange(stridey, input_image.shape[2], self.stride_in)))
+
+                # Space domain convolution
+                # conv_result = conv_result + convolve2d(
+                #    input_image[channeli, stridex::self.stride_in, stridey::self.stride_in].squeeze(),
+                #    self.W[filteri,channeli,:,:].squeeze(),
+                #    mode='same')
+                #    #mode='valid')
+
+                # FFT convolution
+                #conv_result = conv_result + fftconvolve(
+                #    input_image[channeli, stridex::self.stride_in, stridey::self.stride_in].squeeze(),
+                #    self.W[filteri,channeli,:,:].squeeze(),
+                #    mode='same')
+
+                # FFT convolution (cache filter transformations)
+                # Every filter sees the same input spectrum, so transform each
+                # channel once, multiply by all filters together and sum over
+                # channels before the (one per filter) inverse transform.
+                convolve_image = input_image[:, stridex::self.stride_in, stridey::self.stride_in]
+                conv_size = (self.kernel_size + convolve_image.shape[1] - 1, self.kernel_size + convolve_image.shape[2] - 1)
+
+                fsize = tuple(2 ** np.ceil(np.log2(conv_size)).astype(int))
+                fslice = tuple([slice(None)] + [slice(0, int(sz)) for sz in conv_size])
+
+                image_fft = rfftn(convolve_image, fsize, axes=(1, 2))
+                conv_fft = np.einsum('cij,kcij->kij', image_fft, self.filter_fft(fsize))
+                fft_result = irfftn(conv_fft, fsize, axes=(1, 2))[fslice]
+
+                conv_results = _centered(fft_result, (self.nkernels, stride_shape[0], stride_shape[1])).astype(np.float32)
+
+                # if mode == "full":
+                #     return ret
+                # elif mode == "same":
+                #     return _centered(ret, s1)
+                # elif mode == "valid":
+                #     return _centered(ret, abs(s1 - s2) + 1)
 
-                        conv_result += _centered(fft_result.real, conv_result.shape)
+                for filteri in range(self.nkernels):
 
-                        # if mode == "full":
-                        #     return ret
-                        # elif mode == "same":
-                        #     return _centered(ret, s1)
-                        # elif mode == "valid":
-                        #     return _centered(ret, abs(s1 - s2) + 1)
+                    conv_result = conv_results[filteri]
 
                     # Apply maxpool (record switches)
 
@@ -251,6 +257,9 @@ class ConvolutionMaxpoolLayer(object):
         self.W = self.W - learning_rate * gradW
         self.b = self.b - learning_rate * gradb
 
+        # cached filter spectra are stale now
+        self.fft_cache.clear()
+
         return error_in
 
 
@@ -0,0 +1,63 @@
+import numpy as np
+from scipy.ndimage import find_objects
+
+# Per-block index of the labels in a volume, stored next to the 'labels'
+# dataset so later stages don't have to rescan the whole volume:
+#   label_index/labels - sorted label ids (including 0, if present)
+#   label_index/counts - voxel count for each label
+#   label_index/bounds - bounding box for each label, as
+#                        (lo0, lo1, lo2, hi0, hi1, hi2) with hi exclusive
+INDEX_NAME = 'label_index'
+
+def block_index(data, offset=(0, 0, 0)):
+    # index a 3D array (or part of one, at the given offset)
+    ids, packed = np.unique(data, return_inverse=True)
+    packed = packed.reshape(data.shape)
+    counts = np.bincount(packed.ravel(), minlength=len(ids)).astype(np.uint64)
+    bounds = np.zeros((len(ids), 6), dtype=np.int64)
+    for idx, slices in enumerate(find_objects(packed + 1)):
+        bounds[idx, :3] = [s.start + o for s, o in zip(slices, offset)]
+        bounds[idx, 3:] = [s.stop + o for s, o in zip(slices, offset)]
+    return ids, counts, bounds
+
+def combine_indices(parts):
+    # merge several (ids, counts, bounds) indices into one
+    parts = list(parts)
+    if len(parts) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64), np.zeros((0, 6), dtype=np.int64)
+    all_ids = np.concatenate([p[0] for p in parts])
+    all_counts = np.concatenate([p[1] for p in parts])
+    all_bounds = np.vstack([p[2] for p in parts])
+    ids, inverse = np.unique(all_ids, return_inverse=True)
+    counts = np.zeros(len(ids), dtype=np.uint64)
+    np.add.at(counts, inverse, all_counts)
+    bounds = np.zeros((len(ids), 6), dtype=np.int64)
+    bounds[:, :3] = np.iinfo(np.int64).max
+    np.minimum.at(bounds[:, :3], inverse, all_bounds[:, :3])
+    np.maximum.at(bounds[:, 3:], inverse, all_bounds[:, 3:])
+    return ids, counts, bounds
+
+def compute_label_index(labels):
+    # works on arrays and HDF5 datasets, one Z plane at a time
+    return combine_indices(block_index(labels[:, :, Z:Z + 1], (0, 0, Z))
+                           for Z in range(labels.shape[2]))
+
+def remap_label_index(index, new_ids):
+    # relabel an index (new_ids is the new id of each entry), combining any
+    # labels that are now the same
+    ids, counts, bounds = index
+    return combine_indices([(np.asarray(new_ids), counts, bounds)])
+
+def write_label_index(h5file, index):
+    ids, counts, bounds = index
+    group = h5file.create_group(INDEX_NAME)
+    group.create_dataset('labels', data=ids)
+    group.create_dataset('counts', data=counts)
+    group.create_dataset('bounds', data=bounds)
+
+def read_label_index(h5file):
+    # returns None for files written without an index
+    if INDEX_NAME not in h5file:
+        return None
+    group = h5file[INDEX_NAME]
+    return group['labels'][...], group['counts'][...], group['bounds'][...]
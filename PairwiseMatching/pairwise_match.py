@@ -5,8 +5,52 @@ import os
 
 import h5py
 import fast64counter
+import label_index
 
 import time
+from itertools import product
+
+def work_by_chunks(dataset):
+    # walk the chunk grid of the dataset (or the whole dataset if unchunked)
+    chunks = dataset.chunks if dataset.chunks is not None else dataset.shape
+    bases = [range(0, size, step) for size, step in zip(dataset.shape, chunks)]
+    for base in product(*bases):
+        yield tuple(slice(lo, lo + step) for lo, step in zip(base, chunks))
+
+def absolute_slice(region, shape):
+    # resolve negative / open-ended slices, for reading from HDF5
+    return tuple(slice(*s.indices(n)) for s, n in zip(region, shape))
+
+def build_merge_table(remap, dtype):
+    # map each merged label to the root of its merge tree, as a pair of
+    # sorted arrays (from, to)
+    table_from = np.array(sorted(remap.keys()), dtype=dtype)
+    table_to = np.zeros(len(table_from), dtype=dtype)
+    for idx, val in enumerate(table_from):
+        while val in remap and val != remap[val]:
+            val = remap[val]
+        table_to[idx] = val
+    return table_from, table_to
+
+def apply_label_table(label_table, data):
+    table_from, table_to = label_table
+    if len(table_from) == 0:
+        return data
+    idx = np.minimum(table_from.searchsorted(data), len(table_from) - 1)
+    return np.where(table_from[idx] == data, table_to[idx], data).astype(data.dtype)
+
+def relabel_block(inlabels, outlabels, label_table, index):
+    # stream a block through the label table, one chunk at a time, and
+    # return the label index of the result
+    index_parts = []
+    for chunk_slice in work_by_chunks(inlabels):
+        relabeled = apply_label_table(label_table, inlabels[chunk_slice])
+        outlabels[chunk_slice] = relabeled
+        if index is None:
+            index_parts.append(label_index.block_index(relabeled, [s.start for s in chunk_slice]))
+    if index is not None:
+        return label_index.remap_label_index(index, apply_label_table(label_table, index[0]))
+    return label_index.combine_indices(index_parts)
 
 
 Debug = False
@@ -43,11 +87,33 @@ minoverlap_single_ratio = 0.9; # If either overlap is above this then join
 
 print 'Running pairwise matching', " ".join(sys.argv[1:])
 
-# Extract overlapping regions
+# Find the overlapping regions
+
+lo_block1 = [0, 0, 0];
+hi_block1 = [None, None, None]
+lo_block2 = [0, 0, 0];
+hi_block2 = [None, None, None]
+
+# Adjust for Matlab HDF5 storage order
+#direction = 3 - direction
+direction = direction - 1
+
+# Adjust overlapping region boundaries for direction
+lo_block1[direction] = - 2 * halo_size
+hi_block2[direction] = 2 * halo_size;
+
+block1_slice = tuple(slice(l, h) for l, h in zip(lo_block1, hi_block1))
+block2_slice = tuple(slice(l, h) for l, h in zip(lo_block2, hi_block2))
+
+# Extract overlapping regions - only the overlap is read here, the rest of
+# each block is streamed through the merge table on output
 for ntry in range(5):
     try:
         bl1f = h5py.File(block1_path, 'r')
-        block1 = bl1f['labels'][...]
+        block1_shape = bl1f['labels'].shape
+        block1_dtype = bl1f['labels'].dtype
+        overlap1 = bl1f['labels'][absolute_slice(block1_slice, block1_shape)]
+        index1 = label_index.read_label_index(bl1f)
         label_chunks = bl1f['labels'].chunks
         if 'merges' in bl1f:
             previous_merges1 = bl1f['merges'][...]
@@ -56,7 +122,10 @@ for ntry in range(5):
         bl1f.close()
 
         bl2f = h5py.File(block2_path, 'r')
-        block2 = bl2f['labels'][...]
+        block2_shape = bl2f['labels'].shape
+        block2_dtype = bl2f['labels'].dtype
+        overlap2 = bl2f['labels'][absolute_slice(block2_slice, block2_shape)]
+        index2 = label_index.read_label_index(bl2f)
         if 'merges' in bl2f:
             previous_merges2 = bl2f['merges'][...]
         else:
@@ -68,34 +137,14 @@ for ntry in range(5):
         time.sleep(10)
         pass
 
-assert block1.size == block2.size
+assert np.prod(block1_shape) == np.prod(block2_shape)
 
-# append the blocks, and pack them so we can use the fast 64-bit counter
-stacked = np.vstack((block1, block2))
+# append the overlaps, and pack them so we can use the fast 64-bit counter
+stacked = np.vstack((overlap1.ravel(), overlap2.ravel()))
 inverse, packed = np.unique(stacked, return_inverse=True)
 packed = packed.reshape(stacked.shape)
-packed_block1 = packed[:block1.shape[0], :, :]
-packed_block2 = packed[block1.shape[0]:, :, :]
-
-# extract overlap
-
-lo_block1 = [0, 0, 0];
-hi_block1 = [None, None, None]
-lo_block2 = [0, 0, 0];
-hi_block2 = [None, None, None]
-
-# Adjust for Matlab HDF5 storage order
-#direction = 3 - direction
-direction = direction - 1
-
-# Adjust overlapping region boundaries for direction
-lo_block1[direction] = - 2 * halo_size
-hi_block2[direction] = 2 * halo_size;
-
-block1_slice = tuple(slice(l, h) for l, h in zip(lo_block1, hi_block1))
-block2_slice = tuple(slice(l, h) for l, h in zip(lo_block2, hi_block2))
-packed_overlap1 = packed_block1[block1_slice]
-packed_overlap2 = packed_block2[block2_slice]
+packed_overlap1 = packed[0, :].reshape(overlap1.shape)
+packed_overlap2 = packed[1, :].reshape(overlap2.shape)
 print "block1", block1_slice, packed_overlap1.shape
 print "block2", block2_slice, packed_overlap2.shape
 
@@ -110,11 +159,11 @@ areas = dict(zip(*areacounter.get_counts()))
 
 if Debug:
     from libtiff import TIFF
-    for image_i in range(block1.shape[2]):
-        tif = TIFF.open('block1_z{0:04}.tif'.format(image_i), mode='w')
-        tif.write_image(np.uint8(block1[:, :, image_i] * 13 % 251))
-        tif = TIFF.open('block2_z{0:04}.tif'.format(image_i), mode='w')
-        tif.write_image(np.uint8(block2[:, :, image_i] * 13 % 251))
+    for image_i in range(overlap1.shape[2]):
+        tif = TIFF.open('overlap1_z{0:04}.tif'.format(image_i), mode='w')
+        tif.write_image(np.uint8(overlap1[:, :, image_i] * 13 % 251))
+        tif = TIFF.open('overlap2_z{0:04}.tif'.format(image_i), mode='w')
+        tif.write_image(np.uint8(overlap2[:, :, image_i] * 13 % 251))
     for image_i in range(packed_overlap1.shape[2]):
         tif = TIFF.open('packed_overlap1_z{0:04}.tif'.format(image_i), mode='w')
         tif.write_image(np.uint8(packed_overlap1[:, :, image_i] * 13 % 251))
@@ -188,21 +237,27 @@ for l1, l2, overlap_area in zip(overlap_labels1, overlap_labels2, overlap_areas)
 #     # pylab.title('packed_overlap2 post steal')
 #     # pylab.show()
 
-# handle merges by rewriting the inverse
+# handle merges with a label-to-label table
 merge_map = dict(reversed(sorted(s)) for s in to_merge)
-for idx, val in enumerate(inverse):
-    if val in merge_map:
-        while val in merge_map:
-            val = merge_map[val]
-        inverse[idx] = val
+merge_table = build_merge_table(merge_map, block1_dtype)
+inverse = apply_label_table(merge_table, inverse)
 
-# Remap and merge
+# Remap and merge, streaming each block through the merge table
 out1 = h5py.File(outblock1_path + '_partial', 'w')
 out2 = h5py.File(outblock2_path + '_partial', 'w')
-outblock1 = out1.create_dataset('/labels', block1.shape, block1.dtype, chunks=label_chunks, compression='gzip')
-outblock2 = out2.create_dataset('/labels', block2.shape, block2.dtype, chunks=label_chunks, compression='gzip')
-outblock1[...] = inverse[packed_block1]
-outblock2[...] = inverse[packed_block2]
+outblock1 = out1.create_dataset('/labels', block1_shape, block1_dtype, chunks=label_chunks, compression='gzip')
+outblock2 = out2.create_dataset('/labels', block2_shape, block2_dtype, chunks=label_chunks, compression='gzip')
+
+bl1f = h5py.File(block1_path, 'r')
+bl2f = h5py.File(block2_path, 'r')
+out_index1 = relabel_block(bl1f['labels'], outblock1, merge_table, index1)
+out_index2 = relabel_block(bl2f['labels'], outblock2, merge_table, index2)
+bl1f.close()
+bl2f.close()
+
+# index the relabeled blocks for later stages
+label_index.write_label_index(out1, out_index1)
+label_index.write_label_index(out2, out_index2)
 
 # copy any previous merge tables from block 1 to the new output and merge
 if previous_merges1 != None:
@@ -0,0 +1,129 @@
+import os
+import time
+import json
+import socket
+import resource
+
+# [name, seconds] for each Timer block run since the last Telemetry started
+phases = []
+
+# the most pool processes the current job has started at once
+pool_processes = 0
+
+TELEMETRY_SUFFIX = '.telemetry.json'
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, type, value, traceback):
+        elapsed = time.time() - self.start
+        phases.append([self.name, elapsed])
+        print "{0} took {1} seconds".format(self.name, int(elapsed))
+
+def telemetry_path(output_path):
+    return output_path + TELEMETRY_SUFFIX
+
+def reset_peak_memory():
+    # Linux only - lets a long-lived worker measure each job's peak
+    # separately, rather than its own peak so far
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+def peak_memory_mb():
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def pool_started(processes):
+    # Stages call this when they start a multiprocessing pool, so that the
+    # workers' memory is counted in the job's peak
+    global pool_processes
+    pool_processes = max(pool_processes, processes)
+
+def children_peak_memory_mb():
+    # the largest peak of any child process waited for so far (pool workers
+    # are waited for when the pool is joined)
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+def job_peak_memory_mb():
+    # This process's peak, plus the largest worker's peak for each pool
+    # worker (they may all have peaked at once), or None if the workers
+    # haven't been waited for yet
+    memory_mb = peak_memory_mb()
+    if pool_processes > 0:
+        workers_mb = children_peak_memory_mb()
+        if workers_mb == 0:
+            return None
+        memory_mb += workers_mb * pool_processes
+    return memory_mb
+
+def io_bytes():
+    # bytes read and written by this process, including reads served from
+    # the page cache (Linux only)
+    try:
+        counters = dict(line.split(': ') for line in open('/proc/self/io').read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+class Telemetry(object):
+    '''Measures one pipeline job, and writes a record next to its output.
+
+    Create it when the job starts, and call write() once the output is in
+    place.  The record (JSON, in OUTPUT.telemetry.json) has the wall and CPU
+    time, peak memory (including pool workers, see pool_started), bytes read
+    and written, and the time spent in each Timer block.
+    '''
+    def __init__(self, output_path):
+        global pool_processes
+        self.output_path = output_path
+        del phases[:]
+        pool_processes = 0
+        reset_peak_memory()
+        self.start = time.time()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_io = io_bytes()
+
+    def record(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        user = (usage.ru_utime - self.start_usage.ru_utime) + (children.ru_utime - self.start_children.ru_utime)
+        system = (usage.ru_stime - self.start_usage.ru_stime) + (children.ru_stime - self.start_children.ru_stime)
+        read_bytes, written_bytes = io_bytes()
+        if read_bytes is not None and self.start_io[0] is not None:
+            read_bytes -= self.start_io[0]
+            written_bytes -= self.start_io[1]
+        return {'output': self.output_path,
+                'host': socket.gethostname(),
+                'finished': time.time(),
+                'wall_seconds': time.time() - self.start,
+                'user_seconds': user,
+                'system_seconds': system,
+                'cpu_seconds': user + system,
+                'peak_memory_mb': job_peak_memory_mb(),
+                'pool_processes': pool_processes,
+                'read_bytes': read_bytes,
+                'written_bytes': written_bytes,
+                'phases': list(phases)}
+
+    def write(self):
+        # telemetry is only informational, so never fail the job over it
+        path = telemetry_path(self.output_path)
+        try:
+            with open(path + '_partial', 'w') as f:
+                json.dump(self.record(), f, indent=1)
+            os.rename(path + '_partial', path)
+        except (IOError, OSError) as e:
+            print "Could not write telemetry to {0}: {1}".format(path, e)
@@ -3,9 +3,20 @@ import sys
 import h5py
 import numpy as np
 import shutil
+import multiprocessing
+import label_index
+import timer
 
 job_repeat_attempts = 5
 
+# Number of processes used to read input files
+join_read_processes = 4
+
+# Load environment settings
+if 'CONNECTOME_SETTINGS' in os.environ:
+    settings_file = os.environ['CONNECTOME_SETTINGS']
+    execfile(settings_file)
+
 def check_file(filename):
     if not os.path.exists(filename):
         return False
@@ -19,9 +30,52 @@ def check_file(filename):
         return False
     return True
 
-if __name__ == '__main__':
+def dedupe_merges(merges):
+    # merges are unordered pairs, so sort each pair and drop repeated rows
+    merges = np.ascontiguousarray(np.sort(merges.astype(np.uint64), axis=1))
+    rows = merges.view([('l1', np.uint64), ('l2', np.uint64)]).ravel()
+    return np.unique(rows).view(np.uint64).reshape((-1, 2))
+
+def unique_labels(labels):
+    # one Z plane at a time, to avoid loading the whole volume
+    found = np.zeros(0, dtype=labels.dtype)
+    for Z in range(labels.shape[2]):
+        found = np.union1d(found, np.unique(labels[:, :, Z]))
+    return found
+
+def read_merges(filename):
+    try:
+        print filename
+        f = h5py.File(filename, 'r')
+        assert ('merges' in f) or ('labels' in f)
+        merges = [np.zeros((0, 2), dtype=np.uint64)]
+        if 'merges' in f:
+            merges.append(f['merges'][...].astype(np.uint64).reshape((-1, 2)))
+        if 'labels' in f:
+            # write an identity map for the labels
+            index = label_index.read_label_index(f)
+            if index is not None:
+                labels = index[0]
+            else:
+                labels = unique_labels(f['labels'])
+                if 'label_table' in f:
+                    # merge-table-only outputs link to their source labels,
+                    # which are relabeled through label_table
+                    label_table = f['label_table'][...]
+                    idx = np.minimum(label_table[0, :].searchsorted(labels), label_table.shape[1] - 1)
+                    labels = np.unique(np.where(label_table[0, idx] == labels, label_table[1, idx], labels))
+            labels = labels[labels > 0]
+            labels = labels.reshape((-1, 1))
+            merges.append(np.hstack((labels, labels)).astype(np.uint64))
+        f.close()
+        return dedupe_merges(np.vstack(merges))
+    except Exception, e:
+        print e, filename
+        raise
 
-    output_path = sys.argv[-1]
+def concatenate_joins(input_paths, output_path):
+
+    telemetry = timer.Telemetry(output_path)
 
     repeat_attempt_i = 0
     while repeat_attempt_i < job_repeat_attempts and not check_file(output_path):
@@ -31,23 +85,18 @@ if __name__ == '__main__':
         try:
             outf = h5py.File(output_path + '_partial', 'w')
 
-            outmerges = np.zeros((0, 2), dtype=np.uint64)
-            for filename in sys.argv[1:-1]:
-                try:
-                    print filename
-                    f = h5py.File(filename, 'r')
-                    assert ('merges' in f) or ('labels' in f)
-                    if 'merges' in f:
-                        outmerges = np.vstack((outmerges, f['merges'][...].astype(np.uint64)))
-                    if 'labels' in f:
-                        # write an identity map for the labels
-                        labels = np.unique(f['labels'][...])
-                        labels = labels[labels > 0]
-                        labels = labels.reshape((-1, 1))
-                        outmerges = np.vstack((outmerges, np.hstack((labels, labels)).astype(np.uint64)))
-                except Exception, e:
-                    print e, filename
-                    raise
+            # read and deduplicate each input in parallel, then stack once
+            if join_read_processes > 1 and len(input_paths) > 1:
+                pool = multiprocessing.Pool(min(join_read_processes, len(input_paths)))
+                timer.pool_started(min(join_read_processes, len(input_paths)))
+                partial_merges = pool.map(read_merges, input_paths)
+                pool.close()
+                pool.join()
+            else:
+                partial_merges = map(read_merges, input_paths)
+
+            outmerges = dedupe_merges(np.vstack([np.zeros((0, 2), dtype=np.uint64)] + partial_merges))
+            partial_merges = None
 
             if outmerges.shape[0] > 0:
                 outf.create_dataset('merges', outmerges.shape, outmerges.dtype)[...] = outmerges
@@ -67,3 +116,10 @@ if __name__ == '__main__':
                 raise
             
     assert check_file(output_path), "Output file could not be verified after {0} attempts, exiting.".format(job_repeat_attempts)
+
+    # (an output that was already there wasn't measured by this run)
+    if repeat_attempt_i > 0:
+        telemetry.write()
+
+if __name__ == '__main__':
+    concatenate_joins(sys.argv[1:-1], sys.argv[-1])
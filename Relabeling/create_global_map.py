@@ -2,6 +2,8 @@ import os
 import sys
 import h5py
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
 import shutil
 
 job_repeat_attempts = 5
@@ -19,6 +21,27 @@ def check_file(filename):
         return False
     return True
 
+def create_remap(merges):
+    # pack the labels (including background) so they can index a sparse graph
+    merges = merges.astype(np.uint64)
+    labels = np.unique(np.concatenate((np.zeros(1, dtype=np.uint64), merges.ravel())))
+    packed = labels.searchsorted(merges)
+
+    graph = scipy.sparse.coo_matrix((np.ones(packed.shape[0], dtype=np.int32), (packed[:, 0], packed[:, 1])),
+                                    shape=(len(labels), len(labels)))
+    ncomponents, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    # Number the components in order of their lowest label, as the merge
+    # tree always points higher labels to lower ones.  Labels are sorted, so
+    # the first index of each component is its lowest label, and background
+    # (index 0) gets label 0.
+    _, first_index = np.unique(components, return_index=True)
+    component_label = np.zeros(ncomponents, dtype=np.uint64)
+    component_label[np.argsort(first_index)] = np.arange(ncomponents, dtype=np.uint64)
+
+    # needs to be sorted for remap to use searchsorted()
+    return np.vstack((labels, component_label[components]))
+
 if __name__ == '__main__':
 
     input_path = sys.argv[1]
@@ -33,41 +56,13 @@ if __name__ == '__main__':
 
             outf = h5py.File(output_path + '_partial', 'w')
 
-            remap = {}
-            next_label = 1
-
             infile = h5py.File(input_path)
             merges = infile['merges'][...]
 
-            # put every pair in the remap
-            for v1, v2 in merges:
-                remap.setdefault(v1, v1)
-                remap.setdefault(v2, v2)
-                while v1 != remap[v1]:
-                    v1 = remap[v1]
-                while v2 != remap[v2]:
-                    v2 = remap[v2]
-                if v1 > v2:
-                    v1, v2 = v2, v1
-                remap[v2] = v1
-
-            # pack values - every value now either maps to itself (and should get its
-            # own label), or it maps to some lower value (which will have already been
-            # mapped to its final value in this loop).
-            remap[0] = 0
-            for v in sorted(remap.keys()):
-                if v == 0:
-                    continue
-                if remap[v] == v:
-                    remap[v] = next_label
-                    next_label += 1
-                else:
-                    remap[v] = remap[remap[v]]
-
-            # write to hdf5 - needs to be sorted for remap to use searchsorted()
-            ds = outf.create_dataset('remap', (2, len(remap)), merges.dtype)
-            for idx, v in enumerate(sorted(remap.keys())):
-                ds[:, idx] = [v, remap[v]]
+            remap = create_remap(merges)
+
+            # write to hdf5 in one go
+            outf.create_dataset('remap', remap.shape, merges.dtype)[...] = remap
 
             outf.close()
             shutil.move(output_path + '_partial', output_path)
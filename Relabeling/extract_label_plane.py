@@ -4,6 +4,7 @@ import numpy as np
 import h5py
 from libtiff import TIFF
 import shutil
+import timer
 
 job_repeat_attempts = 5
 
@@ -12,9 +13,9 @@ def check_file(filename):
         return False
     return True
 
-if __name__ == '__main__':
+def extract_label_plane(output_path, *plane_args):
 
-    output_path = sys.argv[1]
+    telemetry = timer.Telemetry(output_path)
 
     repeat_attempt_i = 0
     while repeat_attempt_i < job_repeat_attempts and not check_file(output_path):
@@ -24,7 +25,7 @@ if __name__ == '__main__':
         try:
 
             # Parse arguments
-            args = sys.argv[2:]
+            args = list(plane_args)
             output_size = int(args.pop(0))
             zoffset = int(args.pop(0))
             xy_halo = int(args.pop(0))
@@ -36,7 +37,9 @@ if __name__ == '__main__':
                 infile = args.pop(0)
 
                 try:
-                    data = h5py.File(infile, 'r')['labels'][:, :, :]
+                    f = h5py.File(infile, 'r')
+                    data = f['labels'][:, :, :]
+                    f.close()
                 except Exception, e:
                     print e, infile
                     raise
@@ -84,3 +87,10 @@ if __name__ == '__main__':
                 raise
             
     assert check_file(output_path), "Output file could not be verified after {0} attempts, exiting.".format(job_repeat_attempts)
+
+    # (an output that was already there wasn't measured by this run)
+    if repeat_attempt_i > 0:
+        telemetry.write()
+
+if __name__ == '__main__':
+    extract_label_plane(*sys.argv[1:])
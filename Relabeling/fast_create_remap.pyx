@@ -4,47 +4,46 @@
 import numpy as np
 cimport numpy as np
 
+cdef inline np.int64_t find_root(np.int64_t[:] parent, np.int64_t v):
+    # find with path halving
+    while parent[v] != v:
+        parent[v] = parent[parent[v]]
+        v = parent[v]
+    return v
+
 cpdef fast_create_remap(unsigned long long[:,:] merges):
-    cdef unsigned long long mi, v1, v2, idx, v, next_label
-    cdef unsigned long long[:] remap_keys
-    cdef unsigned long long[:,:] ds
-
-    remap = {}
-
-    # put every pair in the remap
-    for mi in range(merges.shape[0]):
-        v1, v2 = merges[mi,:]
-        remap.setdefault(v1, v1)
-        remap.setdefault(v2, v2)
-        while v1 != remap[v1]:
-            v1 = remap[v1]
-        while v2 != remap[v2]:
-            v2 = remap[v2]
+    cdef np.int64_t mi, v1, v2, idx, nlabels
+    cdef np.int64_t[:,:] packed
+    cdef np.int64_t[:] parent
+
+    # pack labels (including background) into indices, so the merge forest
+    # can live in a flat array instead of a dict.  Labels are sorted, so
+    # comparing indices is the same as comparing labels.
+    merges_arr = np.asarray(merges)
+    labels = np.unique(np.concatenate((np.zeros(1, dtype=np.uint64), merges_arr.ravel())))
+    packed = labels.searchsorted(merges_arr).astype(np.int64)
+    nlabels = len(labels)
+
+    parent_arr = np.arange(nlabels, dtype=np.int64)
+    parent = parent_arr
+
+    # put every pair in the forest, always linking higher to lower
+    for mi in range(packed.shape[0]):
+        v1 = find_root(parent, packed[mi, 0])
+        v2 = find_root(parent, packed[mi, 1])
         if v1 > v2:
             v1, v2 = v2, v1
-        remap[v2] = v1
-
-    # pack values - every value now either maps to itself (and should get its
-    # own label), or it maps to some lower value (which will have already been
-    # mapped to its final value in this loop).
-    remap[0] = np.uint64(0)
-    next_label = np.uint64(1)
-    remap_keys = np.uint64(sorted(remap.keys()))
-    for idx in range(len(remap_keys)):
-        v = remap_keys[idx]
-        if v == np.uint64(0):
-            continue
-        if remap[v] == v:
-            remap[v] = next_label
-            next_label += 1
-        else:
-            remap[v] = remap[remap[v]]
-
-    # write to hdf5 - needs to be sorted for remap to use searchsorted()
-    ds = np.zeros((2, len(remap)), dtype=np.uint64)
-    for idx in range(len(remap_keys)):
-        v = remap_keys[idx]
-        ds[0, idx] = v
-        ds[1, idx] = remap[v]
-
-    return ds
+        parent[v2] = v1
+
+    # every parent is lower than its child, so one pass in increasing order
+    # points every entry at its root
+    for idx in range(nlabels):
+        parent[idx] = parent[parent[idx]]
+
+    # pack values - each root gets its own label, in increasing order, with
+    # background (index 0) staying 0
+    is_root = parent_arr == np.arange(nlabels, dtype=np.int64)
+    root_label = np.cumsum(is_root).astype(np.uint64) - np.uint64(1)
+
+    # needs to be sorted for remap to use searchsorted()
+    return np.vstack((labels, root_label[parent_arr]))
@@ -3,9 +3,20 @@ import sys
 import h5py
 import numpy as np
 import shutil
+from itertools import product
+import label_index
+import timer
 
 job_repeat_attempts = 5
 
+# Remap one HDF5 chunk at a time, so memory use does not depend on block size
+remap_in_chunks = True
+
+# Load environment settings
+if 'CONNECTOME_SETTINGS' in os.environ:
+    settings_file = os.environ['CONNECTOME_SETTINGS']
+    execfile(settings_file)
+
 def check_file(filename):
     if not os.path.exists(filename):
         return False
@@ -14,16 +25,29 @@ def check_file(filename):
     f = h5py.File(filename, 'r')
     fkeys = f.keys()
     f.close()
-    if set(fkeys) != set(['labels']):
+    if set(fkeys) - set([label_index.INDEX_NAME]) != set(['labels']):
         os.unlink(filename)
         return False
     return True
 
-if __name__ == '__main__':
+def work_by_chunks(dataset):
+    # walk the chunk grid of the dataset (or the whole dataset if unchunked)
+    chunks = dataset.chunks if dataset.chunks is not None else dataset.shape
+    bases = [range(0, size, step) for size, step in zip(dataset.shape, chunks)]
+    for base in product(*bases):
+        yield tuple(slice(lo, lo + step) for lo, step in zip(base, chunks))
 
-    block_path = sys.argv[1]
-    map_path = sys.argv[2]
-    output_path = sys.argv[3]
+def apply_remap(remap, data, label_table=None):
+    # blocks from pairwise matching with merge_tables_only are relabeled
+    # through their label table first
+    if label_table is not None:
+        idx = np.minimum(label_table[0, :].searchsorted(data), label_table.shape[1] - 1)
+        data = np.where(label_table[0, idx] == data, label_table[1, idx], data)
+    return remap[1, remap[0, :].searchsorted(data)]
+
+def remap_block(block_path, map_path, output_path):
+
+    telemetry = timer.Telemetry(output_path)
 
     repeat_attempt_i = 0
     while repeat_attempt_i < job_repeat_attempts and not check_file(output_path):
@@ -39,20 +63,41 @@ if __name__ == '__main__':
 
             remap = mapf['remap'][...]
 
-            # TODO: loop in chunks?
-            blockdata = blockf['labels'][...]
-            blockdata = remap[0, :].searchsorted(blockdata)
-            blockdata = remap[1, blockdata]
+            inlabels = blockf['labels']
+            label_table = blockf['label_table'][...] if 'label_table' in blockf else None
+            l = outf.create_dataset('labels', inlabels.shape, remap.dtype, chunks=inlabels.chunks, compression='gzip')
+
+            input_index = label_index.read_label_index(blockf)
+            index_parts = []
+
+            if remap_in_chunks:
+                for chunk_slice in work_by_chunks(inlabels):
+                    remapped = apply_remap(remap, inlabels[chunk_slice], label_table)
+                    l[chunk_slice] = remapped
+                    if input_index is None:
+                        index_parts.append(label_index.block_index(remapped, [s.start for s in chunk_slice]))
+            else:
+                remapped = apply_remap(remap, inlabels[...], label_table)
+                l[...] = remapped
+                if input_index is None:
+                    index_parts.append(label_index.block_index(remapped))
+
+            # carry the label index forward, relabeled, if the input has one
+            if input_index is not None:
+                output_index = label_index.remap_label_index(input_index, apply_remap(remap, input_index[0]))
+            else:
+                output_index = label_index.combine_indices(index_parts)
+            label_index.write_label_index(outf, output_index)
 
             #inverse, packed_vol = np.unique(blockdata, return_inverse=True)
             #nlabels_end = len(inverse)
             #print "Remap block ending with {0} segments.".format(nlabels_end)
 
-            l = outf.create_dataset('labels', blockdata.shape, blockdata.dtype, chunks=blockf['labels'].chunks, compression='gzip')
-            l[:, :, :] = blockdata
             print "Wrote remapped block of size", l.shape
             outf.flush()
             outf.close()
+            blockf.close()
+            mapf.close()
             shutil.move(output_path + '_partial', output_path)
 
         except IOError as e:
@@ -65,3 +110,10 @@ if __name__ == '__main__':
                 raise
             
     assert check_file(output_path), "Output file could not be verified after {0} attempts, exiting.".format(job_repeat_attempts)
+
+    # (an output that was already there wasn't measured by this run)
+    if repeat_attempt_i > 0:
+        telemetry.write()
+
+if __name__ == '__main__':
+    remap_block(*sys.argv[1:4])
@@ -0,0 +1,230 @@
+import multiprocessing
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import timer
+
+# Open-source solvers for the window fusion problem, for nodes without
+# CPLEX.  The problem is to choose segments and links to maximize their
+# total weight, where
+#   - at most one segment of each exclusion set is chosen, and
+#   - a link can only be chosen if both its segments are, and each segment
+#     has at most one chosen link to each side (as the first or the second
+#     segment of the link).
+#
+# Each solver is called as solve(problem, mipgap, threads), and returns
+# boolean arrays of the chosen segments and links.  (These solvers use one
+# thread; threads is for CPLEX.)
+#   'lp'     - solves the LP relaxation, and rounds it
+#   'greedy' - takes the heaviest segments, then the heaviest links
+# Both are heuristics: unlike CPLEX, their solutions are feasible but may
+# weigh less than the best.
+#
+# Segments are only constrained by the segments they share an exclusion set
+# or a link with, so the problem splits into independent subproblems, one
+# per connected component of that graph (see solve_by_components).
+
+class FusionProblem(object):
+    def __init__(self, segment_weights, exclusions, link_segs1, link_segs2, link_weights):
+        # exclusions has a row per exclusion set, padded with 0s.  Segment 0
+        # is the background, and is never chosen.
+        self.segment_weights = np.asarray(segment_weights, dtype=np.float64)
+        self.exclusions = exclusions
+        self.link_segs1 = np.asarray(link_segs1, dtype=np.int64)
+        self.link_segs2 = np.asarray(link_segs2, dtype=np.int64)
+        self.link_weights = np.asarray(link_weights, dtype=np.float64)
+        self.num_segments = len(self.segment_weights)
+        self.num_links = len(self.link_weights)
+
+    def exclusion_entries(self):
+        # (exclusion set, segment) for every member of every set
+        rows, cols = np.nonzero(self.exclusions > 0)
+        return rows, self.exclusions[rows, cols].astype(np.int64)
+
+    def constraint_matrix(self):
+        # A @ [segments, links] <= b, as a CSR matrix
+        excl_rows, excl_segs = self.exclusion_entries()
+        num_exclusions = len(self.exclusions)
+        link_idx = np.arange(self.num_links)
+        rows = [excl_rows]
+        cols = [excl_segs]
+        vals = [np.ones(len(excl_rows))]
+        # each segment's links on one side - segment >= sum(links)
+        row_offset = num_exclusions
+        for segs in [self.link_segs1, self.link_segs2]:
+            linked, seg_rows = np.unique(segs, return_inverse=True)
+            rows += [row_offset + np.arange(len(linked)), row_offset + seg_rows]
+            cols += [linked, self.num_segments + link_idx]
+            vals += [-np.ones(len(linked)), np.ones(self.num_links)]
+            row_offset += len(linked)
+        A = scipy.sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=(row_offset, self.num_segments + self.num_links)).tocsr()
+        b = np.zeros(row_offset)
+        b[:num_exclusions] = 1
+        return A, b
+
+    def components(self):
+        # (number of components, component of each segment) of the graph
+        # joining the segments of each exclusion set and of each link
+        excl_rows, excl_segs = self.exclusion_entries()
+        # (each set's first member is never padding)
+        firsts = self.exclusions[excl_rows, 0].astype(np.int64)
+        sources = np.concatenate((firsts, self.link_segs1))
+        targets = np.concatenate((excl_segs, self.link_segs2))
+        graph = scipy.sparse.coo_matrix((np.ones(len(sources)), (sources, targets)),
+                                        shape=(self.num_segments, self.num_segments))
+        return scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    def subproblem(self, segments):
+        # The problem restricted to segments (sorted, and a union of whole
+        # components), and the indices of its links in this problem.  Its
+        # segment 0 is a new background, so segments[i] becomes i + 1.
+        local = np.zeros(self.num_segments, dtype=np.int64)
+        local[segments] = np.arange(1, len(segments) + 1)
+        link_idxs = np.nonzero(local[self.link_segs1] > 0)[0]
+        exclusions = self.exclusions[local[self.exclusions[:, 0]] > 0]
+        # renumbering keeps the members of each set in descending order
+        exclusions = local[exclusions].astype(self.exclusions.dtype)
+        sub = FusionProblem(np.concatenate(([0], self.segment_weights[segments])),
+                            exclusions,
+                            local[self.link_segs1[link_idxs]],
+                            local[self.link_segs2[link_idxs]],
+                            self.link_weights[link_idxs])
+        return sub, link_idxs
+
+    def objective(self):
+        weights = np.concatenate((self.segment_weights, self.link_weights))
+        # never choose the background
+        weights[0] = 0
+        return weights
+
+def round_solution(problem, segment_values, link_values):
+    # Choose segments and then links in decreasing order of their value in
+    # some (possibly fractional) solution, then weight, skipping any that
+    # would break a constraint.  Everything with positive weight that still
+    # fits is added, so the result is never worse than the values given.
+    segment_weights = problem.segment_weights.copy()
+    segment_weights[0] = 0
+
+    excl_rows, excl_segs = problem.exclusion_entries()
+    order = np.argsort(excl_segs, kind='mergesort')
+    excl_rows = excl_rows[order]
+    excl_segs = excl_segs[order]
+    excl_starts = np.searchsorted(excl_segs, np.arange(problem.num_segments + 1))
+
+    on_segments = np.zeros(problem.num_segments, dtype=np.bool)
+    used_exclusions = np.zeros(len(problem.exclusions), dtype=np.bool)
+    for seg in np.lexsort((-segment_weights, -segment_values)):
+        if segment_weights[seg] <= 0:
+            continue
+        seg_exclusions = excl_rows[excl_starts[seg]:excl_starts[seg + 1]]
+        if used_exclusions[seg_exclusions].any():
+            continue
+        on_segments[seg] = True
+        used_exclusions[seg_exclusions] = True
+
+    on_links = np.zeros(problem.num_links, dtype=np.bool)
+    used_first = np.zeros(problem.num_segments, dtype=np.bool)
+    used_second = np.zeros(problem.num_segments, dtype=np.bool)
+    for link in np.lexsort((-problem.link_weights, -link_values)):
+        seg1 = problem.link_segs1[link]
+        seg2 = problem.link_segs2[link]
+        if problem.link_weights[link] <= 0 or not (on_segments[seg1] and on_segments[seg2]):
+            continue
+        if used_first[seg1] or used_second[seg2]:
+            continue
+        on_links[link] = True
+        used_first[seg1] = True
+        used_second[seg2] = True
+
+    return on_segments, on_links
+
+def solve_greedy(problem, mipgap=None, threads=None):
+    return round_solution(problem, np.zeros(problem.num_segments), np.zeros(problem.num_links))
+
+def solve_lp(problem, mipgap=None, threads=None):
+    from scipy.optimize import linprog
+    A, b = problem.constraint_matrix()
+    c = -problem.objective()
+    try:
+        result = linprog(c, A_ub=A, b_ub=b, bounds=(0, 1), method='highs')
+    except ValueError:
+        # scipy before 1.6 (all of them under Python 2), without HiGHS
+        result = linprog(c, A_ub=A, b_ub=b, bounds=(0, 1), method='interior-point', options={'sparse': True})
+    if result.x is None:
+        print "LP failed ({0}), using greedy solution".format(result.message)
+        return solve_greedy(problem)
+    return round_solution(problem, result.x[:problem.num_segments], result.x[problem.num_segments:])
+
+def solve_subproblem(args):
+    # pool worker for solve_by_components
+    solve, mipgap, threads, problem = args
+    return solve(problem, mipgap, threads)
+
+def solve_by_components(problem, solve, mipgap=0.002, processes=1, task_segments=1000, threads=1):
+    # Solve each connected component of problem separately with solve.
+    # Segments with no exclusions or links are on if their weight is
+    # positive.  The rest of the components are grouped, largest first, into
+    # subproblems of at least task_segments segments (so each small
+    # component doesn't pay for setting up a solver), which are solved in a
+    # pool of up to processes processes if there is more than one.  The
+    # solves share threads between them, so the pool is no bigger than that.
+    num_components, component = problem.components()
+    sizes = np.bincount(component, minlength=num_components)
+    # (a link from a segment to itself doesn't join it to anything, but
+    # still constrains it)
+    constrained = sizes > 1
+    constrained[component[problem.link_segs1]] = True
+
+    on_segments = (problem.segment_weights > 0) & ~constrained[component]
+    on_segments[0] = False
+    on_links = np.zeros(problem.num_links, dtype=np.bool)
+
+    # the background is isolated, so it is never in a task
+    order = np.argsort(-sizes, kind='mergesort')
+    order = order[constrained[order]]
+    print num_components, "components,", len(order), "with constraints, largest", sizes.max(), "segments"
+    task_components = []
+    task_size = 0
+    for c in order:
+        if task_size == 0:
+            task_components.append([])
+        task_components[-1].append(c)
+        task_size += sizes[c]
+        if task_size >= task_segments:
+            task_size = 0
+
+    in_task = np.zeros(num_components, dtype=np.bool)
+    tasks = []
+    for components in task_components:
+        in_task[:] = False
+        in_task[components] = True
+        segments = np.nonzero(in_task[component])[0]
+        sub, link_idxs = problem.subproblem(segments)
+        tasks.append((segments, link_idxs, sub))
+
+    # (pool workers, as when run in-process by the driver, can't start
+    # their own pools)
+    workers = min(processes, max(threads, 1), len(tasks))
+    if multiprocessing.current_process().daemon:
+        workers = 1
+    task_args = [(solve, mipgap, max(1, threads // workers), task[2]) for task in tasks]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        timer.pool_started(workers)
+        results = pool.imap(solve_subproblem, task_args)
+    else:
+        results = (solve_subproblem(args) for args in task_args)
+
+    for (segments, link_idxs, _), (sub_segments, sub_links) in zip(tasks, results):
+        on_segments[segments] = sub_segments[1:]
+        on_links[link_idxs] = sub_links
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return on_segments, on_links
+
+SOLVERS = {'lp': solve_lp,
+           'greedy': solve_greedy}
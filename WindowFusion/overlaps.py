@@ -7,13 +7,14 @@ import fast64counter
 
 DEBUG = False
 
-def work_by_chunks(dataset):
-    ychunk, xchunk = dataset.chunks[:2]
+def work_by_chunks(dataset, chunks=None):
+    # chunks gives the chunk shape for arrays that don't have one
+    ychunk, xchunk = (chunks if chunks is not None else dataset.chunks)[:2]
     for xbase in range(0, dataset.shape[0], xchunk):
         for ybase in range(0, dataset.shape[1], ychunk):
             yield slice(xbase, xbase + xchunk), slice(ybase, ybase + ychunk)
 
-def condense_labels(Z, numsegs, labels):
+def condense_labels(Z, numsegs, labels, chunks=None):
     # project all labels at a given Z into a single plane, then merge any that
     # end up mapping to the same projected subregions (merge = remove one of
     # them)
@@ -26,7 +27,7 @@ def condense_labels(Z, numsegs, labels):
     # identifying similar regions, this is fine.
     overlap_counter = fast64counter.ValueCountInt64()
     sublabel_offset = 0
-    for xslice, yslice in work_by_chunks(labels):
+    for xslice, yslice in work_by_chunks(labels, chunks):
         chunklabels = [labels[yslice, xslice, S, Z][...] for S in range(numsegs)]
         projected = chunklabels[0] > 0
         for S in range(1, numsegs):
@@ -62,7 +63,7 @@ def condense_labels(Z, numsegs, labels):
     remapper[remapper > 0] = np.arange(final_label_count + 1, dtype=np.int32)
 
     # remap the labels by chunk
-    for xslice, yslice in work_by_chunks(labels):
+    for xslice, yslice in work_by_chunks(labels, chunks):
         for S in range(numsegs):
             l = labels[yslice, xslice, S, Z]
             labels[yslice, xslice, S, Z] = remapper[l]
@@ -74,10 +75,19 @@ def condense_labels(Z, numsegs, labels):
 
 
 
-def count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum_link_distance):
+def unique_rows(rows):
+    # the distinct rows of a 2D array, viewing each row as one value
+    rows = np.ascontiguousarray(rows)
+    if rows.shape[0] == 0:
+        return rows
+    row_values = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    _, first = np.unique(row_values, return_index=True)
+    return rows[first]
+
+def count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum_link_distance, chunks=None):
     areacounter = fast64counter.ValueCountInt64()
     # Count areas of each label
-    for xslice, yslice in work_by_chunks(labels):
+    for xslice, yslice in work_by_chunks(labels, chunks):
         for Z in range(numslices):
             for Seg in range(numsegs):
                 lbls = labels[yslice, xslice, Seg, Z][...]
@@ -90,23 +100,34 @@ def count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum
     assert np.all(np.sort(keys) == np.arange(len(keys)))
 
     def exclusions():
+        # An exclusion set is the labels (other than 0) found at one pixel in
+        # the segmentations of a slice.  The sets come back as one array, a
+        # row per set, with labels in decreasing order and padded with 0s.
+        sets = [np.zeros((0, numsegs), dtype=labels.dtype)]
         for Z in range(numslices):
             print "exl numslices", Z
-            excls = set()
-            for xslice, yslice in work_by_chunks(labels):
-                subimages = [labels[yslice, xslice, Seg, Z][...].ravel() for Seg in range(numsegs)]
-                excls.update(set(zip(*subimages)))
-            # filter out zeros
-            excls = set(tuple(i for i in s if i) for s in excls)
-            for excl in excls:
-                if len(excl) > 1:
-                    yield excl
+            slice_sets = [np.zeros((0, numsegs), dtype=labels.dtype)]
+            for xslice, yslice in work_by_chunks(labels, chunks):
+                pixels = np.column_stack([labels[yslice, xslice, Seg, Z][...].ravel() for Seg in range(numsegs)])
+                slice_sets.append(unique_rows(pixels))
+            # sort each set so its 0s line up at the end, then drop repeats
+            slice_sets = unique_rows(np.sort(np.vstack(slice_sets), axis=1)[:, ::-1])
+            # keep sets of more than one label
+            if numsegs > 1:
+                sets.append(slice_sets[slice_sets[:, 1] > 0])
+        return np.vstack(sets)
 
     def overlaps():
+        # Links between labels that overlap in slices up to
+        # maximum_link_distance apart, as arrays of the two labels and the
+        # worth of the link
+        all_idxs1 = [np.zeros(0, dtype=np.int32)]
+        all_idxs2 = [np.zeros(0, dtype=np.int32)]
+        all_worths = [np.zeros(0, dtype=np.float64)]
         for z_spacing in range(1, maximum_link_distance + 1):
             overlap_areas = fast64counter.ValueCountInt64()
             for Z in range(numslices - z_spacing):
-                for xslice, yslice in work_by_chunks(labels):
+                for xslice, yslice in work_by_chunks(labels, chunks):
                     subimages_d1 = [labels[yslice, xslice, Seg, Z][...].ravel() for Seg in range(numsegs)]
                     subimages_d2 = [labels[yslice, xslice, Seg, Z + z_spacing][...].ravel() for Seg in range(numsegs)]
                     for s1 in subimages_d1:
@@ -118,8 +139,11 @@ def count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum
             idxs2 = idxs2[mask]
             overlap_areas = overlap_areas[mask]
             print len(idxs1), "Overlaps at spacing", z_spacing
-            for idx1, idx2, overlap_area in zip(idxs1, idxs2, overlap_areas):
-                yield idx1, idx2, link_worth(float(areas[idx1]), float(areas[idx2]), float(overlap_area), z_spacing)
+            all_idxs1.append(idxs1)
+            all_idxs2.append(idxs2)
+            all_worths.append(link_worth(areas[idxs1].astype(np.float64), areas[idxs2].astype(np.float64),
+                                         overlap_areas.astype(np.float64), z_spacing))
+        return np.concatenate(all_idxs1), np.concatenate(all_idxs2), np.concatenate(all_worths)
 
     return areas, exclusions(), overlaps()
 
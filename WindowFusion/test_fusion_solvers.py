@@ -0,0 +1,110 @@
+import itertools
+import numpy as np
+import fusion_solvers
+
+# Checks the open-source fusion solvers against brute force on small random
+# problems.  Run with py.test, or as a script.
+
+num_problems = 200
+
+def random_problem(rng, num_segments=8, num_exclusions=3, num_links=4):
+    # segment 0 is the background, and each exclusion set holds its members
+    # in descending order, padded with 0s
+    segment_weights = rng.uniform(-1, 1, num_segments)
+    exclusions = np.zeros((num_exclusions, 3), dtype=np.int32)
+    for row in exclusions:
+        members = rng.choice(np.arange(1, num_segments), rng.randint(1, 4), replace=False)
+        row[:len(members)] = np.sort(members)[::-1]
+    link_segs1 = rng.randint(1, num_segments, num_links)
+    link_segs2 = rng.randint(1, num_segments, num_links)
+    link_weights = rng.uniform(-1, 1, num_links)
+    return fusion_solvers.FusionProblem(segment_weights, exclusions, link_segs1, link_segs2, link_weights)
+
+def solution_vector(problem, on_segments, on_links):
+    return np.concatenate((on_segments, on_links)).astype(np.float64)
+
+def is_feasible(problem, on_segments, on_links):
+    A, b = problem.constraint_matrix()
+    return (not on_segments[0]) and np.all(A.dot(solution_vector(problem, on_segments, on_links)) <= b + 1e-9)
+
+def weight(problem, on_segments, on_links):
+    return problem.objective().dot(solution_vector(problem, on_segments, on_links))
+
+def solve_brute_force(problem, mipgap=None, threads=None):
+    # the best of every choice of segments (never the background) and links
+    A, b = problem.constraint_matrix()
+    objective = problem.objective()
+    best = None
+    best_weight = None
+    for choice in itertools.product([0, 1], repeat=problem.num_segments - 1 + problem.num_links):
+        x = np.array((0,) + choice, dtype=np.float64)
+        if np.all(A.dot(x) <= b) and (best is None or objective.dot(x) > best_weight + 1e-9):
+            best = x
+            best_weight = objective.dot(x)
+    return best[:problem.num_segments] > 0, best[problem.num_segments:] > 0
+
+def problems():
+    rng = np.random.RandomState(0)
+    for i in range(num_problems):
+        yield random_problem(rng)
+
+def test_heuristics_feasible():
+    for problem in problems():
+        best = weight(problem, *solve_brute_force(problem))
+        for solve in [fusion_solvers.solve_greedy, fusion_solvers.solve_lp]:
+            solution = solve(problem)
+            assert is_feasible(problem, *solution)
+            assert weight(problem, *solution) <= best + 1e-9
+
+def test_components_match_whole_problem():
+    for problem in problems():
+        best = weight(problem, *solve_brute_force(problem))
+        for task_segments in [1, 3, 1000]:
+            solution = fusion_solvers.solve_by_components(problem, solve_brute_force,
+                                                          task_segments=task_segments)
+            assert is_feasible(problem, *solution)
+            assert abs(weight(problem, *solution) - best) < 1e-9
+        for solve in [fusion_solvers.solve_greedy, fusion_solvers.solve_lp]:
+            assert is_feasible(problem, *fusion_solvers.solve_by_components(problem, solve, task_segments=2))
+
+def test_components_in_pool():
+    for problem in list(problems())[:10]:
+        best = weight(problem, *solve_brute_force(problem))
+        solution = fusion_solvers.solve_by_components(problem, solve_brute_force, processes=2,
+                                                      task_segments=1, threads=2)
+        assert abs(weight(problem, *solution) - best) < 1e-9
+
+def test_subproblem_renumbering():
+    for problem in problems():
+        num_components, component = problem.components()
+        # the largest component other than the background's
+        sizes = np.bincount(component[1:], minlength=num_components)
+        segments = np.nonzero(component == np.argmax(sizes))[0]
+        segments = segments[segments > 0]
+        sub, link_idxs = problem.subproblem(segments)
+
+        # segments[i] is the subproblem's segment i + 1
+        assert np.all(segments[sub.link_segs1 - 1] == problem.link_segs1[link_idxs])
+        assert np.all(segments[sub.link_segs2 - 1] == problem.link_segs2[link_idxs])
+        assert np.all(sub.segment_weights[1:] == problem.segment_weights[segments])
+        for row in sub.exclusions:
+            members = row[row > 0]
+            assert np.all(np.diff(members) < 0)
+            assert any(set(segments[members - 1]) == set(full_row[full_row > 0]) for full_row in problem.exclusions)
+
+        # a subproblem solution is as feasible, and weighs as much, in the
+        # whole problem
+        sub_segments, sub_links = solve_brute_force(sub)
+        on_segments = np.zeros(problem.num_segments, dtype=np.bool)
+        on_links = np.zeros(problem.num_links, dtype=np.bool)
+        on_segments[segments] = sub_segments[1:]
+        on_links[link_idxs] = sub_links
+        assert is_feasible(problem, on_segments, on_links)
+        assert abs(weight(problem, on_segments, on_links) - weight(sub, sub_segments, sub_links)) < 1e-9
+
+if __name__ == '__main__':
+    test_heuristics_feasible()
+    test_components_match_whole_problem()
+    test_components_in_pool()
+    test_subproblem_renumbering()
+    print "All tests passed"
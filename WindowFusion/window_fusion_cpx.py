@@ -3,14 +3,24 @@ import sys
 import time
 import gc
 import operator
+import multiprocessing
+from collections import deque
 
 import numpy as np
 from scipy.ndimage.measurements import label as ndimage_label
 import h5py
 
-import cplex
+try:
+    import cplex
+except ImportError:
+    # only needed for fusion_solver = 'cplex'
+    cplex = None
 
 import overlaps
+import label_index
+import fusion_solvers
+import timer
+import diced_block
 
 DEBUG = False
 
@@ -24,7 +34,8 @@ def check_file(filename):
     f = h5py.File(filename, 'r')
     fkeys = f.keys()
     f.close()
-    if set(fkeys) != set(['labels', 'seglabels']):
+    # (seglabels isn't kept with seglabels_store = 'scratch')
+    if set(fkeys) - set([label_index.INDEX_NAME, 'seglabels']) != set(['labels']):
         os.unlink(filename)
         return False
     return True
@@ -36,6 +47,35 @@ size_compensation_factor = 0.9
 chunksize = 128  # chunk size in the HDF5
 z_link_dropoff = 0.75  # dropoff factor for links that span more than one Z-slice
 maximum_link_distance = 1
+# Solver for each block - 'cplex', or one of the open-source solvers in
+# fusion_solvers.py: 'lp' (rounded LP relaxation) or 'greedy'.  Both are
+# heuristics, so only 'cplex' finds the best fusion.
+fusion_solver = 'cplex'
+mip_gap = 0.002  # 0.2% tolerance
+solver_threads = 4  # threads CPLEX uses for each block
+cplex_warm_start = True  # start CPLEX from the greedy solution
+# Solve each connected component of the segment/link graph separately,
+# grouped into subproblems of at least component_task_segments segments,
+# with up to component_processes of them solved at once.  They share the
+# solver_threads threads, so the job still uses solver_threads cores.
+solve_components = True
+component_processes = 4
+component_task_segments = 1000
+# Labeling is done in memory, unless the labels would take more than this
+# many MB, in which case they go in an uncompressed, memory-mapped scratch
+# file (in scratch_dir, or next to the output if None).  The driver budgets
+# 4000 MB for each block labeled in batch mode (FusedBlockBatch).
+labels_in_memory_mb = 4000
+scratch_dir = None
+# Where the labels of each segmentation are kept until the fused labels are
+# written: 'hdf5' - gzipped, as seglabels in the output, or 'scratch' -
+# always in the scratch file, which is read back in place and removed once
+# the block is written (seglabels is then left out of the output).  With
+# 'scratch', set scratch_dir to local disk or /dev/shm.
+seglabels_store = 'hdf5'
+# Report pixels where more than one chosen segment is on (which the
+# exclusions should prevent)
+check_label_overlaps = False
 
 # Load environment settings
 if 'CONNECTOME_SETTINGS' in os.environ:
@@ -67,12 +107,46 @@ class timed(object):
 def offset_labels(Z, seg, labels, offset):
     if offset == 0:
         return
-    for xslice, yslice in overlaps.work_by_chunks(labels):
-        l = labels[yslice, xslice, seg, Z][...]
-        l[l > 0] += offset
-        labels[yslice, xslice, seg, Z] = l
-
-def build_model(areas, exclusions, links):
+    l = labels[:, :, seg, Z]
+    l[l > 0] += offset
+
+def scratch_labels_path(output_path):
+    scratch_path = output_path + '_scratch'
+    if scratch_dir is not None:
+        scratch_path = os.path.join(scratch_dir, os.path.basename(scratch_path))
+    return scratch_path
+
+def label_buffer(shape, output_path):
+    # Returns an array for the labels, and the scratch file holding it (or
+    # None if it's in memory).  Each labeled plane is contiguous.
+    if seglabels_store != 'scratch' and np.prod(shape) * 4 <= labels_in_memory_mb * 2 ** 20:
+        return np.zeros(shape, dtype=np.int32, order='F'), None
+    scratch_path = scratch_labels_path(output_path)
+    print "Labeling in scratch file", scratch_path
+    # (an .npy file, so it can be reopened without knowing its shape)
+    return np.lib.format.open_memmap(scratch_path, mode='w+', dtype=np.int32,
+                                     shape=shape, fortran_order=True), scratch_path
+
+def remove_scratch_labels(output_path):
+    scratch_path = scratch_labels_path(output_path)
+    if os.path.exists(scratch_path):
+        os.unlink(scratch_path)
+
+def link_constraints(segs, link_vars):
+    # One constraint per segment, that it is on if any of its links are:
+    # segment - sum(links) >= 0.  Links are grouped by segment like the rows
+    # of a CSR matrix.
+    if len(segs) == 0:
+        return []
+    order = np.argsort(segs, kind='mergesort')
+    segs = segs[order]
+    link_vars = link_vars[order]
+    row_starts = np.flatnonzero(np.concatenate(([True], segs[1:] != segs[:-1])))
+    rows = np.split(link_vars, row_starts[1:])
+    return [cplex.SparsePair(ind = [int(segidx)] + row.tolist(), val = [1] + [-1] * len(row))
+            for segidx, row in zip(segs[row_starts], rows)]
+
+def build_model(segment_weights, exclusions, links, threads=None):
     ##################################################
     # Generate the LP problem
     ##################################################
@@ -82,53 +156,52 @@ def build_model(areas, exclusions, links):
 
     # Build the LP
     model = cplex.Cplex()
-    num_segments = len(areas)
+    num_segments = len(segment_weights)
     print "  segments", num_segments
     # Create variables for the segments and links
-    model.variables.add(obj = segment_worth(areas),
+    model.variables.add(obj = segment_weights,
                         lb = [0] * num_segments,
                         ub = [1] * num_segments,
                         types = ["B"] * num_segments)
 
     print "Adding exclusions"
-    # Add exclusion constraints
-    for ct, excl in enumerate(exclusions):
-        model.linear_constraints.add(lin_expr = [cplex.SparsePair(ind = [int(i) for i in excl],
-                                                                  val = [1] * len(excl))],
-                                     senses = "L",
-                                     rhs = [1])
-    #print "  ", len(exclusions), "exclusions"
+    # Add exclusion constraints, one row of the exclusions (without its 0
+    # padding) per constraint
+    if len(exclusions) > 0:
+        excl_mask = exclusions > 0
+        excl_rows = np.split(exclusions[excl_mask], np.cumsum(excl_mask.sum(axis=1))[:-1])
+        model.linear_constraints.add(lin_expr = [cplex.SparsePair(ind = excl.tolist(), val = [1] * len(excl))
+                                                 for excl in excl_rows],
+                                     senses = "L" * len(excl_rows),
+                                     rhs = [1] * len(excl_rows))
+    print "  ", len(exclusions), "exclusions"
 
     print "finding links"
-    # add links and link constraints
-    uplinksets = {}
-    downlinksets = {}
-    link_to_segs = {}
-    for idx1, idx2, weight in links:
-        linkidx = model.variables.get_num()
-        model.variables.add(obj = [weight], lb = [0], ub = [1], types = "B", names = ['link%d' % linkidx])
-        uplinksets[idx1] = uplinksets.get(idx1, []) + [linkidx]
-        downlinksets[idx2] = downlinksets.get(idx2, []) + [linkidx]
-        link_to_segs[linkidx] = (idx1, idx2)
-
-    print "found", model.variables.get_num() - num_segments, "links"
+    # add links and link constraints.  link_to_segs[i] is the (lower, higher)
+    # pair of segments joined by link variable num_segments + i.
+    link_segs1, link_segs2, link_weights = links
+    num_links = len(link_weights)
+    link_to_segs = np.column_stack((link_segs1, link_segs2)).astype(np.int64)
+    link_vars = np.arange(num_segments, num_segments + num_links)
+    model.variables.add(obj = link_weights.tolist(),
+                        lb = [0] * num_links,
+                        ub = [1] * num_links,
+                        types = "B" * num_links,
+                        names = ['link%d' % linkidx for linkidx in link_vars])
+
+    print "found", num_links, "links"
     print "adding links"
-    for segidx, linklist in uplinksets.iteritems():
-        model.linear_constraints.add(lin_expr = [cplex.SparsePair(ind = [int(segidx)] + linklist,
-                                                                  val = [1] + [-1] * len(linklist))],
-                                     senses = "G",
-                                     rhs = [0])
-
-    for segidx, linklist in downlinksets.iteritems():
-        model.linear_constraints.add(lin_expr = [cplex.SparsePair(ind = [int(segidx)] + linklist,
-                                                                  val = [1] + [-1] * len(linklist))],
-                                     senses = "G",
-                                     rhs = [0])
+    # each linked segment must be on if any of its links (up or down) are
+    for segs in [link_to_segs[:, 0], link_to_segs[:, 1]]:
+        link_rows = link_constraints(segs, link_vars)
+        model.linear_constraints.add(lin_expr = link_rows,
+                                     senses = "G" * len(link_rows),
+                                     rhs = [0] * len(link_rows))
 
     print "done"
     model.objective.set_sense(model.objective.sense.maximize)
-    model.parameters.threads.set(4) 
-    model.parameters.mip.tolerances.mipgap.set(0.002)  # 0.2% tolerance
+    model.parameters.threads.set(threads if threads is not None else solver_threads)
+    model.parameters.mip.tolerances.mipgap.set(mip_gap)
     # model.parameters.emphasis.memory.set(1)  # doesn't seem to help
     model.parameters.emphasis.mip.set(1)
     model.parameters.simplex.tolerances.feasibility.set(1e-9)
@@ -136,51 +209,31 @@ def build_model(areas, exclusions, links):
     # model.write("theproblem.lp")
     return model, link_to_segs
 
-if __name__ == '__main__':
-    input_path = sys.argv[1]
-    block_offset = int(sys.argv[2]) << 32
-    output_path = sys.argv[3]
-
-    repeat_attempt_i = 0
-    while repeat_attempt_i < job_repeat_attempts and not check_file(output_path):
-
-        repeat_attempt_i += 1
-
-        try:
-
-            h5f = h5py.File(input_path)
-            segmentations = h5f['segmentations']
+def label_and_count(input_path, output_path):
+    # Label each segmentation of each slice into the partial output, and
+    # count the overlaps between them.
+    h5f = diced_block.open_block(input_path)
+    segmentations = h5f['segmentations']
 
-            ##################################################
-            # compute all overlaps between multisegmentations
-            ##################################################
-            height, width, numsegs, numslices = segmentations.shape
-
-            # ensure we can store all the labels we need to
-            assert (height * width * numsegs * numslices) < (2 ** 31 - 1), \
-                "Cube too large.  Must be smaller than 2**31 - 1 voxels."
-
-            largest_index = numslices * numsegs * width * height
+    ##################################################
+    # compute all overlaps between multisegmentations
+    ##################################################
+    height, width, numsegs, numslices = segmentations.shape
 
-            st = time.time()
+    # ensure we can store all the labels we need to
+    assert (height * width * numsegs * numslices) < (2 ** 31 - 1), \
+        "Cube too large.  Must be smaller than 2**31 - 1 voxels."
 
-            # Precompute labels, store in HDF5
+    st = time.time()
 
-            try:
-                lf = h5py.File(output_path, 'r')
-                if 'labels' in lf.keys():
-                    print "Output already generated"
-                    lf.close()
-                    sys.exit(0)
-            except Exception, e:
-                print e
-                pass
+    # Label in memory (or scratch), and store in HDF5 once done
 
-            condense_labels = timed(overlaps.condense_labels)
+    condense_labels = timed(overlaps.condense_labels)
 
-            lf = h5py.File(output_path + '_partial', 'w')
-            chunking = [chunksize, chunksize, 1, 1]
-            labels = lf.create_dataset('seglabels', segmentations.shape, dtype=np.int32, chunks=tuple(chunking), compression='gzip')
+    chunking = [chunksize, chunksize, 1, 1]
+    labels, scratch_path = label_buffer(segmentations.shape, output_path)
+    try:
+        with timer.Timer("labeling"):
             total_regions = 0
             cross_Z_offset = 0
             for Z in range(numslices):
@@ -191,100 +244,236 @@ if __name__ == '__main__':
                     offset_labels(Z, seg_idx, labels, this_slice_offset)
                     this_slice_offset += numregions
                     total_regions += numregions
-                condensed_count = condense_labels(Z, numsegs, labels)
+                condensed_count = condense_labels(Z, numsegs, labels, chunking)
                 print "Labeling depth %d: original %d, condensed %d" % (Z, this_slice_offset, condensed_count)
                 for seg_idx in range (numsegs):
                     offset_labels(Z, seg_idx, labels, cross_Z_offset)
                 cross_Z_offset += condensed_count
                 # XXX - apply cross-D offset
-            print "Labeling took", int(time.time() - st), "seconds, ", condense_labels.total_time, "in condensing"
-            print cross_Z_offset, "total labels", total_regions, "before condensing"
+        print "Labeling took", int(time.time() - st), "seconds, ", condense_labels.total_time, "in condensing"
+        print cross_Z_offset, "total labels", total_regions, "before condensing"
+
+        if DEBUG:
+            assert np.max(labels) == cross_Z_offset
+
+        lf = h5py.File(output_path + '_partial', 'w')
+        if seglabels_store == 'scratch':
+            labels.flush()
+        else:
+            with timer.Timer("writing seglabels"):
+                out_seglabels = lf.create_dataset('seglabels', segmentations.shape, dtype=np.int32, chunks=tuple(chunking), compression='gzip')
+                # a slice at a time, each filling whole chunks
+                for Z in range(numslices):
+                    out_seglabels[:, :, :, Z] = labels[:, :, :, Z]
+        lf.close()
+
+        with timer.Timer("overlaps"):
+            areas, exclusions, links = overlaps.count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum_link_distance, chunking)
+        num_segments = len(areas)
+        assert num_segments == cross_Z_offset + 1  # areas includes an area for 0
+    except:
+        # don't leave the scratch file (which may be in /dev/shm) behind
+        labels = None
+        remove_scratch_labels(output_path)
+        raise
+
+    labels = None
+    if scratch_path is not None and seglabels_store != 'scratch':
+        os.unlink(scratch_path)
+    h5f.close()
+    return areas, exclusions, links
+
+# Python 2 can't send a message of 2GB or more through a pool's pipe, so a
+# block whose overlaps are bigger than this is labeled again in the batch
+# process instead
+MAX_PREPARED_BYTES = 2 ** 31 - 2 ** 26
+
+def prepare_block(args):
+    # Batch mode pool worker - label and count overlaps for a block, to send
+    # back for solving
+    input_path, output_path = args
+    del timer.phases[:]
+    areas, exclusions, links = label_and_count(input_path, output_path)
+    prepared_bytes = areas.nbytes + exclusions.nbytes + sum(l.nbytes for l in links)
+    if prepared_bytes > MAX_PREPARED_BYTES:
+        raise ValueError("Overlaps of {0} take {1} bytes, too many to send from the labeling process".format(
+            input_path, prepared_bytes))
+    return areas, exclusions, links, list(timer.phases)
+
+def solve_cplex(problem, mipgap=None, threads=None):
+    # (build_model uses mip_gap)
+    with timer.Timer("building MILP"):
+        model, links_to_segs = build_model(problem.segment_weights, problem.exclusions,
+                                           (problem.link_segs1, problem.link_segs2, problem.link_weights),
+                                           threads)
+
+    if cplex_warm_start:
+        start_segments, start_links = fusion_solvers.solve_greedy(problem)
+        start = np.concatenate((np.nonzero(start_segments)[0], problem.num_segments + np.nonzero(start_links)[0]))
+        model.MIP_starts.add(cplex.SparsePair(ind = start.tolist(), val = [1] * len(start)),
+                             model.MIP_starts.effort_level.auto)
+
+    model.solve()
+
+    values = np.array(model.solution.get_values())
+    return values[:problem.num_segments] > 0.5, values[problem.num_segments:] > 0.5
+
+def choose_segments_and_links(areas, exclusions, links):
+    # Solve the fusion problem with fusion_solver, and return which segments
+    # and links are on
+    problem = fusion_solvers.FusionProblem(segment_worth(areas.astype(np.float64)), exclusions, *links)
+    print "Solving with", fusion_solver
+    if fusion_solver == 'cplex':
+        assert cplex is not None, "fusion_solver 'cplex' needs the cplex module"
+        solve = solve_cplex
+    else:
+        solve = fusion_solvers.SOLVERS[fusion_solver]
+    if solve_components:
+        return fusion_solvers.solve_by_components(problem, solve, mip_gap,
+                                                  component_processes, component_task_segments,
+                                                  solver_threads)
+    return solve(problem, mip_gap, solver_threads)
+
+def solve_fusion(areas, exclusions, links, block_offset):
+    # Solve the fusion problem, and return the map from each segment label to
+    # its fused label (0 for segments left out)
+    num_segments = len(areas)
+    link_segs1, link_segs2, link_weights = links
+
+    with timer.Timer("solving"):
+        on_segments, on_links = choose_segments_and_links(areas, exclusions, links)
+
+    # free memory
+    areas = exclusions = links = None
+    gc.collect()
+
+    # Build the map from incoming label to linked labels
+    on_segments[0] = 0  # CPLEX might not turn off the background segment
+    print on_segments.sum(), "active segments"
+    segment_map = np.arange(num_segments, dtype=np.uint64)
+    segment_map[~ on_segments] = 0
+
+    # Process links
+    print on_links.sum(), "active links"
+    for linkidx in np.nonzero(on_links)[0]:
+        l1, l2 = link_segs1[linkidx], link_segs2[linkidx]
+        assert on_segments[l1]
+        assert on_segments[l2]
+        segment_map[l2] = l1 # link higher to lower
+        print "linked", l2, "to", l1
+
+    # set background to 0
+    segment_map[0] = 0
+    # Compress labels
+    next_label = 1
+    for idx in range(1, len(segment_map)):
+        if segment_map[idx] == idx:
+            segment_map[idx] = next_label
+            next_label += 1
+        else:
+            segment_map[idx] = segment_map[segment_map[idx]]
+
+    assert (segment_map > 0).sum() == on_segments.sum()
+    segment_map[segment_map > 0] |= block_offset
+
+    for linkidx in np.nonzero(on_links)[0]:
+        l1, l2 = link_segs1[linkidx], link_segs2[linkidx]
+        # CMOR: This assertion fails for cube2 block_3_5_5.
+        #assert segment_map[l1] == segment_map[l2]
+
+    return segment_map
+
+def write_fused_labels(output_path, segment_map):
+    # Write the fused labels into the partial output, and move it into place
+    lf = h5py.File(output_path + '_partial', 'r+')
+    if seglabels_store == 'scratch':
+        # mapped in place - no copy, and nothing to decompress
+        labels = np.load(scratch_labels_path(output_path), mmap_mode='r')
+    else:
+        labels = lf['seglabels']
+    height, width, numsegs, numslices = labels.shape
+    chunking = [chunksize, chunksize, 1, 1]
+
+    if DEBUG:
+        # Sanity check
+        on_segments = segment_map > 0
+        areas, exclusions, links = overlaps.count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum_link_distance, chunking)
+        #TODO: This assert triggers on lgn data = CMOR
+        assert np.all(on_segments[exclusions].sum(axis=1) <= 1)
+
+    # Condense results
+    out_labels = lf.create_dataset('labels', [height, width, numslices], dtype=np.uint64,
+                                   chunks=(chunking[0], chunking[1], chunking[3]), compression='gzip')
+    with timer.Timer("writing labels"):
+        index_parts = []
+        for Z in range(numslices):
+            # read all the segmentations of the slice at once, and combine
+            # them in memory
+            fused = segment_map[labels[:, :, :, Z]]
+            if check_label_overlaps:
+                overlapping = (fused != 0).sum(axis=2) > 1
+                if overlapping.any():
+                    print "BAZ", Z, fused[overlapping]
+            fused = np.bitwise_or.reduce(fused, axis=2)
+            out_labels[:, :, Z] = fused
+            index_parts.append(label_index.block_index(fused[:, :, np.newaxis], (0, 0, Z)))
+
+    # store the label index, so later stages don't need to rescan the block
+    label_index.write_label_index(lf, label_index.combine_indices(index_parts))
+
+    # copy over probabilities
+    #in_probs = h5f['probabilities']
+    #out_probs = lf.create_dataset('probabilities', in_probs.shape, dtype=in_probs.dtype, chunks=in_probs.chunks, compression='gzip')
+    #out_probs[...] = in_probs[...]
+    lf.close()
+
+    labels = None
+    if seglabels_store == 'scratch':
+        os.unlink(scratch_labels_path(output_path))
+
+    # move to final location
+    if os.path.exists(output_path):
+        os.unlink(output_path)
+
+    os.rename(output_path+ '_partial', output_path)
+    print "Successfully wrote", output_path
+
+def already_fused(output_path):
+    try:
+        lf = h5py.File(output_path, 'r')
+        done = 'labels' in lf.keys()
+        lf.close()
+        return done
+    except Exception, e:
+        print e
+        return False
 
-            if DEBUG:
-                assert np.max(labels) == cross_Z_offset
+def fuse_block(input_path, global_block_number, output_path):
+    if already_fused(output_path):
+        print "Output already generated"
+        return
 
-            areas, exclusions, links = overlaps.count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth, maximum_link_distance)
-            num_segments = len(areas)
-            assert num_segments == cross_Z_offset + 1  # areas includes an area for 0
+    telemetry = timer.Telemetry(output_path)
 
-            st = time.time()
-            model, links_to_segs = build_model(areas, exclusions, links)
-            print "Building MILP took", int(time.time() - st), "seconds"
+    # (an output that was already there wasn't measured by this run)
+    if fuse_block_attempts(input_path, global_block_number, output_path):
+        telemetry.write()
 
-            # free memory
-            areas = exclusions = links = None
-            gc.collect()
-
-            print "Solving"
-            model.solve()
-            print "Solving took", int(time.time() - st), "seconds"
-
-            # Build the map from incoming label to linked labels
-            on_segments = np.array(model.solution.get_values(range(num_segments))).astype(np.bool)
-            on_segments[0] = 0  # CPLEX might not turn off the background segment
-            print on_segments.sum(), "active segments"
-            segment_map = np.arange(num_segments, dtype=np.uint64)
-            segment_map[~ on_segments] = 0
-
-            if DEBUG:
-                # Sanity check
-                areas, exclusions, links = overlaps.count_overlaps_exclusionsets(numslices, numsegs, labels, link_worth)
-                #TODO: This assert triggers on lgn data = CMOR
-                for excl in exclusions:
-                    assert sum(on_segments[s] for s in excl) <= 1
-
-            # Process links
-            link_vars = np.array(model.solution.get_values()).astype(np.bool)
-            link_vars[:num_segments] = 0
-            print link_vars.sum(), "active links"
-            for linkidx in np.nonzero(link_vars)[0]:
-                l1, l2 = links_to_segs[linkidx]
-                assert on_segments[l1]
-                assert on_segments[l2]
-                segment_map[l2] = l1 # link higher to lower
-                print "linked", l2, "to", l1
-
-            # set background to 0
-            segment_map[0] = 0
-            # Compress labels
-            next_label = 1
-            for idx in range(1, len(segment_map)):
-                if segment_map[idx] == idx:
-                    segment_map[idx] = next_label
-                    next_label += 1
-                else:
-                    segment_map[idx] = segment_map[segment_map[idx]]
-
-            assert (segment_map > 0).sum() == on_segments.sum()
-            segment_map[segment_map > 0] |= block_offset
-
-            for linkidx in np.nonzero(link_vars)[0]:
-                l1, l2 = links_to_segs[linkidx]
-                # CMOR: This assertion fails for cube2 block_3_5_5.
-                #assert segment_map[l1] == segment_map[l2]
-
-            # Condense results
-            out_labels = lf.create_dataset('labels', [height, width, numslices], dtype=np.uint64,
-                                           chunks=(chunking[0], chunking[1], chunking[3]), compression='gzip')
-            for Z in range(numslices):
-                for seg_idx in range(numsegs):
-                    if (out_labels[:, :, Z][...].astype(bool) * segment_map[labels[:, :, seg_idx, Z]].astype(bool)).sum() != 0:
-                        badsegs = out_labels[:, :, Z][...].astype(bool) * segment_map[labels[:, :, seg_idx, Z]].astype(bool) != 0
-                        print "BAZ", out_labels[:, :, Z][badsegs], segment_map[labels[:, :, seg_idx, Z]][badsegs]
-                    out_labels[:, :, Z] |= segment_map[labels[:, :, seg_idx, Z]]
-
-            # copy over probabilities
-            #in_probs = h5f['probabilities']
-            #out_probs = lf.create_dataset('probabilities', in_probs.shape, dtype=in_probs.dtype, chunks=in_probs.chunks, compression='gzip')
-            #out_probs[...] = in_probs[...]
-            lf.close()
-
-            # move to final location
-            if os.path.exists(output_path):
-                os.unlink(output_path)
+def fuse_block_attempts(input_path, global_block_number, output_path):
+    # Fuse a block, retrying if it fails.  Returns whether this run wrote
+    # the output.
+    block_offset = int(global_block_number) << 32
 
-            os.rename(output_path+ '_partial', output_path)
-            print "Successfully wrote", sys.argv[3]
+    repeat_attempt_i = 0
+    while repeat_attempt_i < job_repeat_attempts and not check_file(output_path):
+
+        repeat_attempt_i += 1
+
+        try:
+            areas, exclusions, links = label_and_count(input_path, output_path)
+            segment_map = solve_fusion(areas, exclusions, links, block_offset)
+            areas = exclusions = links = None
+            write_fused_labels(output_path, segment_map)
 
         # except IOError as e:
         #     print "I/O error({0}): {1}".format(e.errno, e.strerror)
@@ -294,6 +483,81 @@ if __name__ == '__main__':
         #     print "Unexpected error:", sys.exc_info()[0]
         #     if repeat_attempt_i == job_repeat_attempts:
         #         pass
+        finally:
+            # (already removed if the block was written)
+            remove_scratch_labels(output_path)
 
     assert check_file(output_path), "Output file could not be verified after {0} attempts, exiting.".format(job_repeat_attempts)
 
+    return repeat_attempt_i > 0
+
+def fuse_blocks(block_args):
+    # Batch mode: fuse several (input_path, global_block_number, output_path)
+    # blocks in one process.  Another process labels and counts overlaps for
+    # the next block while this one solves the current block, so the cores
+    # not used by CPLEX aren't left idle.  Only one block is labeled ahead,
+    # as its overlaps wait in this process until it is solved.  Blocks that
+    # fail are retried one at a time.
+    #
+    # The telemetry covers the whole batch (including the labeling process,
+    # and the phases run in it), and goes next to the first block's output,
+    # where the driver looks for the job's record.
+    pending = deque(b for b in block_args if not already_fused(b[2]))
+    failed = []
+    if not pending:
+        return
+
+    telemetry = timer.Telemetry(block_args[0][2])
+
+    pool = multiprocessing.Pool(1)
+    # (the component solves may run at the same time as the labeling)
+    timer.pool_started(1 + (component_processes if solve_components else 0))
+    prepared = deque()
+    while pending or prepared:
+        # the block to solve now, and the next one
+        while pending and len(prepared) < 2:
+            input_path, global_block_number, output_path = pending.popleft()
+            if os.path.exists(output_path):
+                os.unlink(output_path)
+            prepared.append(((input_path, global_block_number, output_path),
+                             pool.apply_async(prepare_block, ((input_path, output_path),))))
+
+        (input_path, global_block_number, output_path), result = prepared.popleft()
+        print "Fusing", input_path
+        try:
+            areas, exclusions, links, phases = result.get()
+            timer.phases.extend(phases)
+            segment_map = solve_fusion(areas, exclusions, links, int(global_block_number) << 32)
+            areas = exclusions = links = None
+            write_fused_labels(output_path, segment_map)
+            if not check_file(output_path):
+                failed.append((input_path, global_block_number, output_path))
+        except KeyboardInterrupt:
+            pool.terminate()
+            # the blocks labeled ahead won't be fused now
+            for (_, _, prepared_output_path), _ in prepared:
+                remove_scratch_labels(prepared_output_path)
+            raise
+        except:
+            print "Unexpected error fusing {0}: {1}".format(input_path, sys.exc_info()[1])
+            failed.append((input_path, global_block_number, output_path))
+        finally:
+            remove_scratch_labels(output_path)
+
+    pool.close()
+    pool.join()
+
+    for args in failed:
+        print "Retrying", args[0]
+        fuse_block_attempts(*args)
+
+    telemetry.write()
+
+if __name__ == '__main__':
+    # window_fusion_cpx.py INPUT BLOCK_NUMBER OUTPUT
+    # window_fusion_cpx.py --batch INPUT BLOCK_NUMBER OUTPUT [INPUT BLOCK_NUMBER OUTPUT ...]
+    if sys.argv[1] == '--batch':
+        args = sys.argv[2:]
+        fuse_blocks([args[idx:idx + 3] for idx in range(0, len(args), 3)])
+    else:
+        fuse_block(*sys.argv[1:4])